@@ -10,7 +10,17 @@ bl_info = {
 }
 
 import bpy
-from mathutils import Vector
+from bpy.app.handlers import persistent
+
+import Bone_align
+import Bone_core
+import Bone_math
+
+def backup_label(bone_name):
+    return 'bone.weight_alignment: %s' % bone_name
+
+# Single bone backups kept per armature, in their own stack
+BACKUP_LIMIT = 64
 
 class AlignBoneByWeightBackup(bpy.types.Operator):
     bl_idname = "bone.weight_alignment_backup"
@@ -24,12 +34,16 @@ class AlignBoneByWeightBackup(bpy.types.Operator):
                 context.mode == 'EDIT_ARMATURE')
                 
     def execute(self, context):
-        bone = context.object.data.edit_bones[self.bone_name]
-        old_bone = context.scene.bone_name_backup
+        armature = context.object.data
         
-        if bone.name == old_bone:
-            bone.head = eval(context.scene.bone_head_backup)
-            bone.tail = eval(context.scene.bone_tail_backup)
+        # Latest snapshot taken by Align for this bone
+        label = backup_label(self.bone_name)
+        stack = Bone_core.BONE_SNAPSHOTS
+        for snapshot_id, snapshot_label, count in reversed(Bone_core.snapshots(armature, stack)):
+            if snapshot_label == label:
+                Bone_core.restore_snapshot(armature, snapshot_id, stack)
+                Bone_core.remove_snapshot(armature, snapshot_id, stack)
+                break
         
         return {'FINISHED'}
 
@@ -56,59 +70,54 @@ class AlignBoneByWeight(bpy.types.Operator):
                 context.mode == 'EDIT_ARMATURE')
 
     def execute(self, context):
-        bone = context.object.data.edit_bones[self.bone_name]
-        object = context.scene.objects[self.object_name]
+        profiler = Bone_core.profiler
+        profiler.start(self.bl_idname)
+
+        with profiler.phase('group lookup'):
+            bone = context.object.data.edit_bones[self.bone_name]
+            object = context.scene.objects[self.object_name]
+            group = object.vertex_groups[bone.name]
 
-        context.scene.bone_name_backup = bone.name
-        context.scene.bone_head_backup = str(bone.head.to_tuple())
-        context.scene.bone_tail_backup = str(bone.tail.to_tuple())
+        with profiler.phase('snapshot'):
+            Bone_core.take_snapshot(
+                context.object.data, backup_label(bone.name), [bone.name],
+                BACKUP_LIMIT, Bone_core.BONE_SNAPSHOTS
+            )
             
         # Preserve length
         length = bone.length
         
         # Calculate Center     
-        group = object.vertex_groups[bone.name]
-        center = [0, 0, 0]
-        total_weight = 0
-        for vert in object.data.vertices:
-            for g in vert.groups:
-                if g.group == group.index:
-                    center = [c + g.weight * v for c, v in zip(center, object.matrix_world @ vert.co)]
-                    total_weight += g.weight
-                
-        if total_weight:
-            center = [c / total_weight for c in center]
-        
-            # Según align
-            if self.align == 'HEAD':
-                bone.head = center
-                
-            elif self.align == 'TAIL':
-                bone.tail = center
-                
-            elif self.align == 'CENTER':
-                center = Vector(center)
-            
-                # Calcula el centro del hueso
-                bone_center = (bone.head + bone.tail) / 2
+        with profiler.phase('centroid'):
+            center, total_weight = Bone_core.object_centroid(object, group.index)
+            center = center.tolist()
                 
-                # Calcula la dirección del hueso
-                bone_dir = bone.tail - bone.head
-                bone_dir.normalize()
+        with profiler.phase('bone write'):
+            if total_weight:
+                head, tail = bone.head, bone.tail
+
+                # Según align
+                if self.align == 'HEAD':
+                    head = center
                 
-                # Calcula la nueva posición de la cabeza y la cola del hueso
-                new_head = center - bone_dir * (bone_center - bone.head).length
-                new_tail = center + bone_dir * (bone.tail - bone_center).length
+                elif self.align == 'TAIL':
+                    tail = center
                 
-                # Alinea el hueso con el centro de los pesos
-                bone.head = new_head
-                bone.tail = new_tail
+                elif self.align == 'CENTER':
+                    # Mueve el hueso entero hasta el centro de los pesos
+                    head, tail = Bone_math.center_segment(head, tail, center)
                 
-                self.report({'INFO'}, self.align)
+                    self.report({'INFO'}, self.align)
                 
-            bone.length = length
-        else:
-            self.report({'ERROR_INVALID_INPUT'}, 'Vertex group has no weights')
+                # Preserve length
+                head, tail = Bone_math.set_length(head, tail, length)
+                bone.head = head.tolist()
+                bone.tail = tail.tolist()
+            else:
+                self.report({'ERROR_INVALID_INPUT'}, 'Vertex group has no weights')
+
+        Bone_align.count_targets([object])
+        profiler.finish()
         
         return {'FINISHED'}
 
@@ -172,6 +181,17 @@ def object_picker_condition(self, obj):
         obj.parent == bpy.context.active_object
     )
     
+@persistent
+def invalidate_weights(scene, depsgraph):
+    # Edited meshes rebuild their weight index on the next alignment
+    for update in depsgraph.updates:
+        if update.is_updated_geometry:
+            Bone_core.invalidate(update.id.name)
+
+@persistent
+def clear_weights(*args):
+    Bone_core.invalidate()
+
 def register():
     bpy.utils.register_class(AlignBoneByWeightBackup)
     bpy.utils.register_class(AlignBoneByWeight)
@@ -190,10 +210,9 @@ def register():
         type = bpy.types.Object,
         poll = object_picker_condition
     )
-    
-    bpy.types.Scene.bone_name_backup = bpy.props.StringProperty()
-    bpy.types.Scene.bone_head_backup = bpy.props.StringProperty()
-    bpy.types.Scene.bone_tail_backup = bpy.props.StringProperty()
+
+    bpy.app.handlers.depsgraph_update_post.append(invalidate_weights)
+    bpy.app.handlers.load_post.append(clear_weights)
 
 def unregister():
     bpy.utils.unregister_class(AlignBoneByWeightBackup)
@@ -202,9 +221,9 @@ def unregister():
     
     del bpy.types.Scene.bone_alignment
     del bpy.types.Scene.weight_target_object
-    del bpy.types.Scene.bone_name_backup
-    del bpy.types.Scene.bone_head_backup
-    del bpy.types.Scene.bone_tail_backup
+
+    bpy.app.handlers.depsgraph_update_post.remove(invalidate_weights)
+    bpy.app.handlers.load_post.remove(clear_weights)
 
 if __name__ == "__main__":
     register()
\ No newline at end of file
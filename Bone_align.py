@@ -0,0 +1,394 @@
+"""
+Alignment on Blender data shared by the add-ons and tools/align_jobs.py:
+target meshes, the VOLUME rays and the batch path from edit bones to
+Bone_math and back. Unlike Bone_core it works on bpy objects directly, and
+unlike the add-ons it has no UI, operators or scene properties.
+
+Install it next to the add-on files with Bone_core.py and Bone_math.py.
+"""
+
+import bpy
+from mathutils import Vector
+from mathutils.bvhtree import BVHTree
+
+import Bone_core
+import Bone_math
+
+# Option names every alignment reads, from the operator props or any object
+# with the same attributes (a job of tools/align_jobs.py)
+OPTIONS = (
+    'preserve_length', 'fit_length', 'length_percentile', 'parent_connect',
+    'align_bone', 'head_between', 'tail_between', 'head_group', 'tail_group',
+    'alignment', 'use_evaluated', 'all_meshes', 'orient', 'orient_roll',
+    'estimator', 'min_weight', 'top_k', 'trim', 'median_iterations', 'ray_count',
+    'ray_samples', 'ray_distance', 'mirror',
+)
+
+def target_objects(rig, object, options):
+    # The target first, then with all_meshes every other mesh parented to
+    # the rig. They share the bone group names
+    targets = [object]
+    if options.all_meshes:
+        targets += [child for child in rig.children if child.type == 'MESH' and child != object]
+    return targets
+
+def target_weights(object, options):
+    # Cached weight index of the base or the evaluated mesh
+    depsgraph = None
+    if options.use_evaluated:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+    return Bone_core.mesh_weights(object, depsgraph)
+
+def group_parts(targets, name, options):
+    # (weights, matrix_world, group index) of every target with the group
+    return [
+        (target_weights(target, options), target.matrix_world, target.vertex_groups[name].index)
+        for target in targets if name in target.vertex_groups
+    ]
+
+# BVHTree of the evaluated mesh per object name, in object space
+_bvh_cache = {}
+
+def invalidate_bvh(name=None):
+    # Drops the tree of an object by name, every tree without name
+    if name is None:
+        _bvh_cache.clear()
+    else:
+        _bvh_cache.pop(name, None)
+
+def object_bvh(object):
+    tree = _bvh_cache.get(object.name)
+    if tree is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        tree = _bvh_cache[object.name] = BVHTree.FromObject(object, depsgraph)
+    return tree
+
+def volume_center(object, head, tail, options):
+    # Mean of the ray hits from points along the bone, None if nothing is hit
+    tree = object_bvh(object)
+    matrix = object.matrix_world
+    inverse = matrix.inverted()
+    rotation = inverse.to_3x3()
+
+    # Directions and distances in object space
+    rays = []
+    for direction in Bone_math.fibonacci_sphere(options.ray_count):
+        direction = rotation @ Vector(direction)
+        rays.append((direction.normalized(), options.ray_distance * direction.length))
+
+    hits = Vector()
+    count = 0
+    for factor in Bone_math.segment_samples(options.ray_samples):
+        origin = inverse @ head.lerp(tail, factor)
+        for direction, distance in rays:
+            location = tree.ray_cast(origin, direction, distance)[0]
+            if location is not None:
+                hits += location
+                count += 1
+
+    if count:
+        return matrix @ (hits / count)
+
+def quality_report(rig, object, options):
+    # Bone_core.quality_report of every bone aligned since the file was
+    # loaded, each against the group it was aligned to. The head/tail
+    # between groups sit past the bone ends, they are only listed
+    armature = rig.data
+    entry = Bone_core.endpoints(armature)
+    edit_bones = armature.edit_bones
+    names = [name for name in entry.previous if name in edit_bones]
+    rows = Bone_core.read_bones(edit_bones)[[edit_bones.find(name) for name in names], :6]
+    original = [entry.previous[name][0] for name in names]
+    groups = [entry.previous[name][1] for name in names]
+    meshes = [
+        (target_weights(target, options), target.matrix_world, [
+            target.vertex_groups[used[0]].index if used[0] in target.vertex_groups else -1 for used in groups
+        ])
+        for target in target_objects(rig, object, options)
+    ]
+
+    report = Bone_core.quality_report(names, rows, original, meshes)
+    for bone, used in zip(report['bones'], groups):
+        bone['groups'] = list(used)
+    report.update(armature=rig.name, target=object.name)
+    return report
+
+def align_bone(bone, options, center=None, head_pos=None, tail_pos=None, segment=None, extent=None):
+    profiler = Bone_core.profiler
+
+    # Principal axis, roll and fitted length math, apart from the write
+    with profiler.phase('solve'):
+        row = Bone_math.align_row(
+            [*bone.head, *bone.tail, bone.roll], options, center, head_pos, tail_pos, segment, extent
+        )
+
+    # Parent connect
+    if options.parent_connect:
+        with profiler.phase('parent connect'):
+            parent = bone.parent
+            if parent:
+                row[0:3] = parent.tail
+
+    with profiler.phase('bone write'):
+        bone.head = row[0:3].tolist()
+        bone.tail = row[3:6].tolist()
+        bone.roll = float(row[6])
+
+def mirror_pairs(bones):
+    # name -> counterpart edit bone for .L/.R style pairs within bones
+    by_name = {bone.name: bone for bone in bones}
+    pairs = {}
+    for name in by_name:
+        other = bpy.utils.flip_name(name)
+        if other != name and other in by_name:
+            pairs[name] = by_name[other]
+    return pairs
+
+def count_targets(targets):
+    # Mesh sizes for the profiler record
+    profiler = Bone_core.profiler
+    if profiler.active:
+        profiler.count('vertices', sum(len(target.data.vertices) for target in targets))
+        profiler.count('groups', sum(len(target.vertex_groups) for target in targets))
+
+def align_bones(bones, targets, options, incremental=False, groups=None):
+    # All centroids in one sweep of each mesh, then every bone is solved on
+    # the [head, tail, roll] rows of the rig, parents before children, and
+    # the rows go back in one bulk write. VOLUME rays only hit the first target.
+    # incremental skips the bones whose fingerprint matches the last run.
+    # groups, when given, gets the vertex groups each aligned bone was fitted to
+    if not bones:
+        return []
+    profiler = Bone_core.profiler
+    meshes = [(target, target_weights(target, options)) for target in targets]
+    sweeps = {}
+
+    def sweep(kind):
+        # The plain mean ('mean') or the principal axes ('segments') of every
+        # group, from one pass over each mesh the first time a bone needs it.
+        # Robust estimators read each group's own slices of the indices
+        if kind not in sweeps:
+            with profiler.phase('centroid'):
+                if kind == 'mean':
+                    sweeps[kind] = [
+                        (target.vertex_groups, Bone_core.group_centroids(
+                            weights, target.matrix_world, len(target.vertex_groups), [
+                                target.vertex_groups[name].index
+                                for name in swept if name in target.vertex_groups
+                            ]
+                        ))
+                        for target, weights in meshes
+                    ]
+                else:
+                    target, weights = meshes[0]
+                    sweeps[kind] = Bone_core.group_segments(
+                        weights, target.matrix_world, len(target.vertex_groups)
+                    )
+        return sweeps[kind]
+
+    def parts(name):
+        return [
+            (weights, target.matrix_world, target.vertex_groups[name].index)
+            for target, weights in meshes if name in target.vertex_groups
+        ]
+
+    def centroid(name):
+        if options.estimator == 'MEAN' and name in swept:
+            return Bone_math.merge_centroids([
+                (centers[groups[name].index], totals[groups[name].index])
+                for groups, (centers, totals) in sweep('mean') if name in groups
+            ])
+        return Bone_core.parts_centroid(parts(name), options)
+
+    def segment(name):
+        # From the sweep with a single mesh
+        if len(meshes) == 1:
+            heads, tails, secondaries, _ = sweep('segments')
+            index = targets[0].vertex_groups[name].index
+            return heads[index], tails[index], secondaries[index]
+        return Bone_core.parts_segment(parts(name))
+
+    def present(name):
+        return bool(name) and any(name in target.vertex_groups for target in targets)
+
+    # The whole rig as rows, with the hierarchy
+    edit_bones = bones[0].id_data.edit_bones
+    rows = Bone_core.read_bones(edit_bones)
+    index = {}
+    for row, bone in enumerate(edit_bones):
+        index[bone.name] = row
+    parents = [-1] * len(rows)
+    for row, bone in enumerate(edit_bones):
+        if bone.parent:
+            parents[row] = index[bone.parent.name]
+    links = Bone_core.connected_links(edit_bones)
+
+    def snap(row):
+        Bone_core.snap_connected(rows, row, *links)
+
+    def inputs(bone, flip=False):
+        # center, head_pos, tail_pos, segment and extent for align_row, None
+        # without weights. flip looks up the head/tail groups of the other side
+        mean, total_weight = centroid(bone.name)
+        if not total_weight:
+            return None
+        if options.alignment == 'VOLUME':
+            row = rows[index[bone.name]]
+            center = volume_center(targets[0], Vector(row[0:3]), Vector(row[3:6]), options)
+        else:
+            center = mean.tolist()
+
+        # Middle of the two centroids. A between group with no weight left
+        # skips the bone, as bs.to_shape does, instead of pulling the end
+        # halfway to the origin
+        ends = []
+        for group, active in ((options.head_group, options.head_between), (options.tail_group, options.tail_between)):
+            if flip:
+                group = bpy.utils.flip_name(group)
+            if not active or not present(group):
+                ends.append(None)
+                continue
+            other, other_weight = centroid(group)
+            if not other_weight:
+                return None
+            ends.append(((mean + other) / 2).tolist())
+
+        return [
+            center,
+            *ends,
+            segment(bone.name) if options.orient else None,
+            Bone_core.parts_points(parts(bone.name)) if options.fit_length else None
+        ]
+
+    def fitted(name, flip=False):
+        # The groups inputs reads for name, its own first
+        found = [name]
+        for group, active in ((options.head_group, options.head_between), (options.tail_group, options.tail_between)):
+            if flip:
+                group = bpy.utils.flip_name(group)
+            if active and present(group):
+                found.append(group)
+        return tuple(found)
+
+    def average(found, other):
+        # Each input averaged with the mirrored one of the counterpart
+        if other is None:
+            return found
+        if found is None:
+            found = [None] * 5
+        points = [Bone_math.average_mirrored(mine, theirs) for mine, theirs in zip(found[:3], other[:3])]
+        points = [None if point is None else point.tolist() for point in points]
+        return points + [
+            Bone_math.average_segments(found[3], other[3]),
+            Bone_math.average_extents(found[4], other[4])
+        ]
+
+    pairs = mirror_pairs(bones) if options.mirror != 'NONE' else {}
+
+    # Option values, and the whole first mesh for the VOLUME rays, as the
+    # BVH sees it: modifiers and shape keys applied
+    settings = [repr([(name, getattr(options, name, None)) for name in sorted(OPTIONS)])]
+    if options.alignment == 'VOLUME' and incremental:
+        if options.use_evaluated:
+            coords = meshes[0][1].coords
+        else:
+            coords = Bone_core.evaluated_coords(targets[0], bpy.context.evaluated_depsgraph_get())
+        settings += [coords, targets[0].matrix_world]
+
+    def depends(bone, other):
+        # Fingerprint of everything the result of bone, and of its mirrored
+        # counterpart, depends on besides their own rows
+        names = [bone.name]
+        if options.head_between:
+            names.append(options.head_group)
+        if options.tail_between:
+            names.append(options.tail_group)
+        if other is not None:
+            # Mirror takes the counterpart's result when bone has no weights
+            names += [other.name] + [bpy.utils.flip_name(name) for name in names[1:]]
+        keys = settings + [Bone_core.parts_fingerprint(parts(name)) for name in names]
+        parent = parents[index[bone.name]]
+        if options.parent_connect and parent >= 0:
+            keys.append(rows[parent])
+        return Bone_math.fingerprint(*keys)
+
+    stored = Bone_core.fingerprints(bones[0].id_data) if incremental else {}
+    pending = {}
+
+    # Parents before children, the +X side of a pair first
+    order = sorted(
+        bones, key=lambda bone: (len(bone.parent_recursive), rows[index[bone.name], 0] < 0)
+    )
+
+    # Groups the mean sweep covers: one side of each MIRROR pair, the other
+    # takes the mirrored result, plus the between groups. Anything else (the
+    # second side when the first has no weight) goes to parts_centroid
+    swept = set()
+    copied = set()
+    for bone in order:
+        if bone.name not in copied:
+            swept.add(bone.name)
+            if bone.name in pairs and options.mirror == 'MIRROR':
+                copied.add(pairs[bone.name].name)
+    for between_group, used in ((options.head_group, options.head_between), (options.tail_group, options.tail_between)):
+        if between_group and used:
+            swept.update({between_group, bpy.utils.flip_name(between_group)})
+
+    aligned = []
+    done = set()
+    for bone in order:
+        if bone.name in done:
+            continue
+        other = pairs.get(bone.name)
+        if other is not None and other.name in done:
+            other = None
+
+        # Inputs and rows as the last run left them, nothing to do
+        if incremental:
+            unit = [index[bone.name]] + ([index[other.name]] if other is not None else [])
+            with profiler.phase('fingerprint'):
+                key = depends(bone, other)
+            if stored.get(bone.name) == Bone_math.fingerprint(key, rows[unit]):
+                done.update([bone.name] + ([other.name] if other is not None else []))
+                profiler.count('unchanged bones', len(unit))
+                continue
+            pending[bone.name] = key, unit
+
+        with profiler.phase('centroid'):
+            found = inputs(bone)
+            if other is not None and options.mirror == 'AVERAGE':
+                found = average(found, inputs(other, flip=True))
+        if found is None:
+            continue
+
+        row = index[bone.name]
+        with profiler.phase('solve'):
+            rows[row] = Bone_math.align_row(rows[row], options, *found)
+        if options.parent_connect and parents[row] >= 0:
+            with profiler.phase('parent connect'):
+                rows[row, 0:3] = rows[parents[row], 3:6]
+        snap(row)
+        aligned.append(bone.name)
+        done.add(bone.name)
+        if groups is not None:
+            groups[bone.name] = fitted(bone.name)
+
+        # The counterpart takes the mirrored result, no centroid of its own
+        if other is not None:
+            rows[index[other.name]] = Bone_math.mirror_row(rows[row])
+            snap(index[other.name])
+            aligned.append(other.name)
+            done.add(other.name)
+            if groups is not None:
+                groups[other.name] = fitted(other.name, flip=True)
+
+    if aligned:
+        with profiler.phase('bone write'):
+            Bone_core.write_bones(edit_bones, rows)
+
+    # Stored with the final rows, connected children may have moved a tail
+    # after its bone was solved. Bones without weights are kept too
+    for name, (key, unit) in pending.items():
+        stored[name] = Bone_math.fingerprint(key, rows[unit])
+
+    return aligned
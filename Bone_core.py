@@ -0,0 +1,591 @@
+"""
+Blender side of the weight math shared by "Adjust Bone to Shape" and "Bone
+Weight Alignment": reads meshes, weights and bones into arrays for Bone_math,
+caches the weight index, keeps backups and the profiler.
+
+Has no bl_info so Blender does not list it as an add-on, install it next to
+the add-on files with Bone_math.py. Never imports bpy, Blender data is read
+through the objects the operators pass in.
+"""
+
+import contextlib
+import csv
+import json
+import time
+
+import numpy as np
+
+import Bone_math
+
+def local_coords(mesh):
+    # Every vertex position in one bulk copy
+    count = len(mesh.vertices)
+    coords = np.empty(count * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', coords)
+    return coords.reshape(count, 3)
+
+class MeshWeights:
+    # Every vertex group of a mesh in compressed sparse rows: the members of
+    # group g are vertices[indptr[g]:indptr[g + 1]] with the matching weights
+    def __init__(self, groups, vertices, weights, coords=None):
+        # One (group, vertex, weight) per deform entry, in any order
+        groups = np.asarray(groups, dtype=np.int64)
+        order = np.argsort(groups, kind='stable')
+        self.groups = groups[order]
+        self.vertices = np.asarray(vertices, dtype=np.int64)[order]
+        self.weights = np.asarray(weights, dtype=np.float64)[order]
+
+        counts = np.bincount(groups)
+        self.indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+
+        self.mesh_name = None
+        self.version = None
+        self.vertex_count = len(coords) if coords is not None else 0
+        self._mesh = None
+        self._coords = coords
+        self._gathered = {}
+
+    @classmethod
+    def from_mesh(cls, mesh):
+        # Single Python pass over every vertex and its deform entries, the
+        # API has no bulk read of the weights. Cached until the mesh changes
+        entries = np.array([
+            (g.group, vert.index, g.weight)
+            for vert in mesh.vertices
+            for g in vert.groups
+        ], dtype=np.float64).reshape(-1, 3)
+        weights = cls(entries[:, 0], entries[:, 1], entries[:, 2])
+        weights.mesh_name = mesh.name
+        weights.version = mesh_version(mesh)
+        weights.vertex_count = len(mesh.vertices)
+        weights._mesh = mesh
+        return weights
+
+    @property
+    def coords(self):
+        if self._coords is None:
+            self._coords = local_coords(self._mesh)
+        return self._coords
+
+    def group(self, group_index):
+        # Vertex indices and weights of one group, costs the group size
+        if group_index >= len(self.indptr) - 1:
+            return self.vertices[:0], self.weights[:0]
+        start, end = self.indptr[group_index], self.indptr[group_index + 1]
+        return self.vertices[start:end], self.weights[start:end]
+
+    def group_coords(self, group_index):
+        # Local positions of one group's vertices. Until something needs the
+        # whole array, small groups (fingers on a 300k body) are gathered
+        # from their own vertices only and kept for the next call
+        indices, _ = self.group(group_index)
+        if self._coords is not None or self._mesh is None:
+            return self.coords[indices]
+        if len(indices) * GATHER_RATIO > self.vertex_count:
+            return self.coords[indices]
+
+        gathered = self._gathered.get(group_index)
+        if gathered is None:
+            vertices = self._mesh.vertices
+            gathered = np.array(
+                [vertices[index].co for index in indices.tolist()], dtype=np.float32
+            ).reshape(-1, 3)
+            self._gathered[group_index] = gathered
+        return gathered
+
+class Profiler:
+    # Opt-in timings of the operators. Each run is a record with exclusive
+    # seconds per phase (nested phases are not counted twice), counts and
+    # weight cache hits/misses. While off phase() returns one shared no-op
+    # context, so the instrumented code pays a method call per phase
+    def __init__(self, limit=50):
+        self._enabled = False
+        self.records = []
+        self.limit = limit
+        self._record = None
+        self._inner = 0.0
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, value):
+        # Switching off also drops a run an exception left without finish()
+        self._enabled = value
+        if not value:
+            self._record = None
+
+    @property
+    def active(self):
+        return self._record is not None
+
+    def start(self, operator):
+        # A run an exception left open is dropped, never stored
+        self._record = None
+        if self.enabled:
+            self._inner = 0.0
+            self._record = {
+                'operator': operator,
+                'time': time.time(),
+                'total': time.perf_counter(),
+                'phases': {},
+                'counts': {},
+                'cache_hits': 0,
+                'cache_misses': 0,
+            }
+
+    def phase(self, name):
+        if self._record is None:
+            return _NO_PHASE
+        return _Phase(self, name)
+
+    def count(self, name, value=1):
+        if self._record is not None:
+            counts = self._record['counts']
+            counts[name] = counts.get(name, 0) + value
+
+    def cache(self, hit):
+        if self._record is not None:
+            self._record['cache_hits' if hit else 'cache_misses'] += 1
+
+    def finish(self):
+        record = self._record
+        if record is None:
+            return None
+        self._record = None
+        record['total'] = time.perf_counter() - record['total']
+        self.records.append(record)
+        del self.records[:-self.limit]
+        return record
+
+    def clear(self):
+        self.records.clear()
+
+    def export(self, path):
+        # CSV for .csv paths (one row per value), JSON otherwise
+        if not path.lower().endswith('.csv'):
+            with open(path, 'w', encoding='utf-8') as file:
+                json.dump(self.records, file, indent=2)
+            return
+
+        with open(path, 'w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['run', 'operator', 'time', 'kind', 'name', 'value'])
+            for run, record in enumerate(self.records):
+                rows = [('total', 'total', record['total'])]
+                rows += [('phase', name, value) for name, value in record['phases'].items()]
+                rows += [('count', name, value) for name, value in record['counts'].items()]
+                rows += [('cache', 'hits', record['cache_hits']), ('cache', 'misses', record['cache_misses'])]
+                for kind, name, value in rows:
+                    writer.writerow([run, record['operator'], record['time'], kind, name, value])
+
+class _Phase:
+    __slots__ = ('profiler', 'name', 'start', 'outer')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.outer = self.profiler._inner
+        self.profiler._inner = 0.0
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        profiler = self.profiler
+        elapsed = time.perf_counter() - self.start
+        if profiler._record is not None:
+            phases = profiler._record['phases']
+            phases[self.name] = phases.get(self.name, 0.0) + elapsed - profiler._inner
+        profiler._inner = self.outer + elapsed
+
+_NO_PHASE = contextlib.nullcontext()
+
+# Shared by both add-ons and the panel
+profiler = Profiler()
+
+# MeshWeights per (object name, evaluated), dropped by invalidate() on
+# depsgraph updates
+_mesh_cache = {}
+
+def mesh_version(mesh):
+    # Catches data swaps and topology changes between depsgraph updates
+    return (mesh.as_pointer(), len(mesh.vertices))
+
+def evaluated_weights(object, depsgraph):
+    # Modifiers and shape keys applied, vertex groups carried through them
+    evaluated = object.evaluated_get(depsgraph)
+    mesh = evaluated.to_mesh()
+    try:
+        weights = MeshWeights.from_mesh(mesh)
+        weights._coords = local_coords(mesh)
+        weights._mesh = None
+    finally:
+        evaluated.to_mesh_clear()
+    weights.mesh_name = object.data.name
+    return weights
+
+def evaluated_coords(object, depsgraph):
+    # Vertex positions with modifiers and shape keys applied, no weights read
+    evaluated = object.evaluated_get(depsgraph)
+    mesh = evaluated.to_mesh()
+    try:
+        return local_coords(mesh)
+    finally:
+        evaluated.to_mesh_clear()
+
+def mesh_weights(object, depsgraph=None):
+    # With a depsgraph the evaluated mesh is read instead of object.data
+    key = (object.name, depsgraph is not None)
+    entry = _mesh_cache.get(key)
+    version = mesh_version(object.data)
+    hit = entry is not None and entry.version == version
+    profiler.cache(hit)
+    if not hit:
+        with profiler.phase('vertex scan'):
+            if depsgraph is None:
+                entry = MeshWeights.from_mesh(object.data)
+            else:
+                entry = evaluated_weights(object, depsgraph)
+        entry.version = version
+        _mesh_cache[key] = entry
+    return entry
+
+def cached_weights(object, evaluated=False):
+    # The index mesh_weights would return, None if not built. Never reads the
+    # mesh, for UI code that must stay cheap
+    return _mesh_cache.get((object.name, evaluated))
+
+def invalidate(name=None):
+    # Drops the cache of an object or mesh by name, everything without name
+    if name is None:
+        _mesh_cache.clear()
+        return
+    for key, entry in list(_mesh_cache.items()):
+        if name in (key[0], entry.mesh_name):
+            del _mesh_cache[key]
+
+# A group is gathered vertex by vertex while it has fewer than 1 / GATHER_RATIO
+# of the mesh vertices, one foreach_get of everything is cheaper past that
+GATHER_RATIO = 64
+
+def parts_points(parts):
+    # World points and weights of a group spread over several meshes, parts
+    # being (MeshWeights, matrix_world, group index) per mesh
+    points, weights = [np.empty((0, 3))], [np.empty(0)]
+    for mesh_weights, matrix, group_index in parts:
+        indices, group = mesh_weights.group(group_index)
+        profiler.count('group vertices', len(indices))
+        points.append(Bone_math.to_world(mesh_weights.group_coords(group_index), matrix))
+        weights.append(group)
+    return np.concatenate(points), np.concatenate(weights)
+
+def parts_centroid(parts, options=None):
+    # Plain weighted mean unless options picks a robust estimator
+    points, weights = parts_points(parts)
+    if options is None or options.estimator == 'MEAN':
+        return Bone_math.weighted_centroid(points, weights)
+    return Bone_math.robust_centroid(points, weights, options)
+
+def group_centroid(weights, matrix, group_index, options=None):
+    return parts_centroid([(weights, matrix, group_index)], options)
+
+def object_centroid(object, group_index, depsgraph=None):
+    return group_centroid(mesh_weights(object, depsgraph), object.matrix_world, group_index)
+
+def between_centroids(weights, matrix, group_index, other_index, options=None):
+    # Middle point of two group centroids, None when either has no weight
+    center, total_weight = group_centroid(weights, matrix, group_index, options)
+    other, other_weight = group_centroid(weights, matrix, other_index, options)
+    if not total_weight or not other_weight:
+        return None
+    return (center + other) / 2
+
+def group_centroids(weights, matrix, count=0, indices=None):
+    # Weighted mean of every group in one sweep, rows indexed by group index.
+    # With indices only the entries of those groups are read and summed, the
+    # rows of the others stay empty
+    count = max(count, len(weights.indptr) - 1)
+    if indices is None:
+        points = Bone_math.to_world(weights.coords, matrix)[weights.vertices]
+        return Bone_math.grouped_centroids(weights.groups, weights.weights, points, count)
+
+    wanted = np.zeros(count, dtype=bool)
+    wanted[np.asarray(indices, dtype=np.int64)] = True
+    keep = wanted[weights.groups]
+    points = Bone_math.to_world(weights.coords[weights.vertices[keep]], matrix)
+    return Bone_math.grouped_centroids(weights.groups[keep], weights.weights[keep], points, count)
+
+def parts_fingerprint(parts):
+    # Digest of what a group's result depends on: members, weights, their
+    # local positions and the matrix_world of every mesh with the group
+    arrays = []
+    for mesh_weights, matrix, group_index in parts:
+        indices, group = mesh_weights.group(group_index)
+        arrays += [indices, group, mesh_weights.group_coords(group_index), np.array(matrix)]
+    return Bone_math.fingerprint(*arrays)
+
+def parts_segment(parts):
+    return Bone_math.principal_segment(*parts_points(parts))
+
+def group_segment(weights, matrix, group_index):
+    return parts_segment([(weights, matrix, group_index)])
+
+def group_segments(weights, matrix, count=0):
+    # principal_segment of every group from one sweep over the index
+    count = max(count, len(weights.indptr) - 1)
+    points = Bone_math.to_world(weights.coords, matrix)[weights.vertices]
+    return Bone_math.grouped_segments(weights.groups, weights.weights, points, weights.indptr, count)
+
+def read_bones(edit_bones):
+    # Head, tail and roll of every edit bone as rows of an (n, 7) array
+    count = len(edit_bones)
+    heads = np.empty(count * 3, dtype=np.float32)
+    tails = np.empty(count * 3, dtype=np.float32)
+    rolls = np.empty(count, dtype=np.float32)
+    edit_bones.foreach_get('head', heads)
+    edit_bones.foreach_get('tail', tails)
+    edit_bones.foreach_get('roll', rolls)
+    return np.concatenate([heads.reshape(-1, 3), tails.reshape(-1, 3), rolls[:, None]], axis=1)
+
+def write_bones(edit_bones, rows):
+    rows = np.ascontiguousarray(rows, dtype=np.float32)
+    edit_bones.foreach_set('head', rows[:, 0:3].ravel())
+    edit_bones.foreach_set('tail', rows[:, 3:6].ravel())
+    edit_bones.foreach_set('roll', rows[:, 6].copy())
+
+# Backups live on the armature data as ID properties:
+# armature[stack][str(id)] = {'label', 'names', 'data'}, data being the
+# packed read_bones rows of the named bones. Whole rig snapshots and the
+# single bone backups of bone.weight_alignment are separate stacks, so
+# clicks on one bone never push a rig snapshot out
+SNAPSHOTS = 'bs_snapshots'
+BONE_SNAPSHOTS = 'bs_bone_snapshots'
+
+def snapshots(armature, stack=SNAPSHOTS):
+    # (id, label, bone count) from oldest to newest
+    saved = armature.get(stack, {})
+    return [
+        (int(key), saved[key]['label'], len(saved[key]['data']) // 7)
+        for key in sorted(saved.keys(), key=int)
+    ]
+
+def take_snapshot(armature, label='', names=None, limit=16, stack=SNAPSHOTS, rows=None):
+    # rows, when given, is the whole rig as read_bones returned it before a
+    # change, so the snapshot can wait until something was written
+    edit_bones = armature.edit_bones
+    if rows is None:
+        rows = read_bones(edit_bones)
+    if names is None:
+        names = [bone.name for bone in edit_bones]
+    else:
+        rows = rows[[edit_bones.find(name) for name in names]]
+
+    if stack not in armature:
+        armature[stack] = {}
+    saved = armature[stack]
+    ids = sorted((int(key) for key in saved.keys()))
+    snapshot_id = ids[-1] + 1 if ids else 1
+    saved[str(snapshot_id)] = {
+        'label': label,
+        'names': '\n'.join(names),
+        'data': rows.ravel(),
+    }
+
+    # Oldest first out
+    for old_id in ids[:max(len(ids) + 1 - limit, 0)]:
+        del saved[str(old_id)]
+
+    return snapshot_id
+
+def restore_snapshot(armature, snapshot_id, stack=SNAPSHOTS):
+    # Returns how many bones were restored, bones removed since are skipped
+    snapshot = armature[stack][str(snapshot_id)]
+    names = snapshot['names'].split('\n') if snapshot['names'] else []
+    saved = np.asarray(snapshot['data'], dtype=np.float32).reshape(-1, 7)
+
+    edit_bones = armature.edit_bones
+    indices = np.array([edit_bones.find(name) for name in names], dtype=np.int64)
+    found = indices >= 0
+    if found.all() and len(indices) == len(edit_bones) and (indices == np.arange(len(indices))).all():
+        rows = saved
+    else:
+        # Connected neighbours follow the restored bones, as a head/tail
+        # assignment would move them
+        rows = read_bones(edit_bones)
+        rows[indices[found]] = saved[found]
+        parents, children = connected_links(edit_bones)
+        for row in indices[found].tolist():
+            snap_connected(rows, row, parents, children)
+    write_bones(edit_bones, rows)
+
+    return int(found.sum())
+
+def remove_snapshot(armature, snapshot_id, stack=SNAPSHOTS):
+    del armature[stack][str(snapshot_id)]
+
+class Endpoints:
+    # Head and tail of the bones of the last alignment before (original) and
+    # after it (aligned), as (n, 6) rows, so the blend sliders never touch the
+    # mesh. written is what the sliders last put on each bone. previous keeps
+    # every bone aligned since the file was loaded, with its position before
+    # its latest alignment and the vertex groups it was fitted to (its own
+    # group first), for the quality report
+    def __init__(self):
+        self.names = []
+        self.original = np.empty((0, 6))
+        self.aligned = np.empty((0, 6))
+        self.written = np.empty((0, 6))
+        self.previous = {}
+
+    def record(self, names, original, aligned, groups=None):
+        # A new alignment replaces the bones the sliders move. groups has the
+        # vertex group names of each bone, its own name without them
+        self.names = list(names)
+        self.original = np.array(original, dtype=np.float64).reshape(-1, 6)
+        self.aligned = np.array(aligned, dtype=np.float64).reshape(-1, 6)
+        self.written = self.aligned.copy()
+        if groups is None:
+            groups = [(name,) for name in self.names]
+        for name, row, used in zip(self.names, self.original, groups):
+            self.previous[name] = row, tuple(used)
+
+    def keep(self, mask):
+        # Drops the bones the sliders should no longer move
+        self.names = [name for name, kept in zip(self.names, mask) if kept]
+        self.original = self.original[mask]
+        self.aligned = self.aligned[mask]
+        self.written = self.written[mask]
+
+    def blend(self, head_factor, tail_factor):
+        factors = np.repeat([head_factor, tail_factor], 3)
+        return self.original + (self.aligned - self.original) * factors
+
+# Endpoints per armature data name
+_endpoints = {}
+
+def endpoints(armature, create=True):
+    # Without create None when nothing was recorded, for read-only UI checks
+    if not create:
+        return _endpoints.get(armature.name)
+    if armature.name not in _endpoints:
+        _endpoints[armature.name] = Endpoints()
+    return _endpoints[armature.name]
+
+def connected_links(edit_bones):
+    # Connected parent (-1 without) and connected children by bone index
+    index = {bone.name: row for row, bone in enumerate(edit_bones)}
+    parents = [-1] * len(index)
+    children = [[] for _ in index]
+    for row, bone in enumerate(edit_bones):
+        if bone.parent and bone.use_connect:
+            parents[row] = index[bone.parent.name]
+            children[parents[row]].append(row)
+    return parents, children
+
+def snap_connected(rows, row, parents, children):
+    # What Blender does on every head/tail assignment of a connected bone,
+    # foreach_set skips it
+    if parents[row] >= 0:
+        rows[parents[row], 3:6] = rows[row, 0:3]
+    for child in children[row]:
+        rows[child, 0:3] = rows[row, 3:6]
+
+def blend_bones(armature, head_factor, tail_factor):
+    # Moves every bone of the last alignment at once, returns how many were
+    # moved. Bones edited by hand since the sliders last wrote them (or
+    # deleted) are left alone and dropped from the sliders
+    entry = _endpoints.get(armature.name)
+    if entry is None or not entry.names:
+        return 0
+
+    edit_bones = armature.edit_bones
+    indices = np.array([edit_bones.find(name) for name in entry.names], dtype=np.int64)
+    rows = read_bones(edit_bones)
+    kept = indices >= 0
+    kept[kept] = np.all(np.abs(rows[indices[kept], 0:6] - entry.written[kept]) <= 1e-5, axis=1)
+    entry.keep(kept)
+    indices = indices[kept]
+    if not len(indices):
+        return 0
+
+    rows[indices, 0:6] = entry.blend(head_factor, tail_factor)
+    parents, children = connected_links(edit_bones)
+    for row in indices.tolist():
+        snap_connected(rows, row, parents, children)
+    write_bones(edit_bones, rows)
+    entry.written = rows[indices, 0:6].astype(np.float64)
+
+    return len(indices)
+
+def clear_endpoints():
+    _endpoints.clear()
+
+# Per armature data name, bone name -> fingerprint of the inputs and the
+# written result of its last batch alignment
+_fingerprints = {}
+
+def fingerprints(armature):
+    return _fingerprints.setdefault(armature.name, {})
+
+def clear_fingerprints():
+    _fingerprints.clear()
+
+def quality_report(names, rows, original, meshes, outside=0.25, factor=3.0, floor=0.05):
+    # How well each named bone fits its vertex group. rows and original are
+    # the (n, 6) head/tail now and before the alignment, meshes are
+    # (MeshWeights, matrix_world, group index per name or -1) and every mesh
+    # is swept once. Bones may share a group. Distances and shifts are
+    # compared relative to the bone length, so a finger and the spine weigh
+    # the same, and deviations under floor bone lengths are no outliers
+    rows = np.asarray(rows, dtype=np.float64).reshape(-1, 6)
+    original = np.asarray(original, dtype=np.float64).reshape(-1, 6)
+    sums = np.zeros((len(names), 4))
+    for weights, matrix, indices in meshes:
+        indices = np.asarray(indices, dtype=np.int64)
+        count = len(weights.indptr) - 1
+        found = np.flatnonzero((indices >= 0) & (indices < count))
+        if not len(found):
+            continue
+
+        # The slices of the reported groups, numbered by bone, once per bone
+        # that uses the group
+        starts = weights.indptr[indices[found]]
+        sizes = weights.indptr[indices[found] + 1] - starts
+        bones = np.repeat(found, sizes)
+        entries = np.arange(sizes.sum()) + np.repeat(starts - np.cumsum(sizes) + sizes, sizes)
+        profiler.count('group vertices', len(entries))
+        points = Bone_math.to_world(weights.coords[weights.vertices[entries]], matrix)
+        sums += Bone_math.grouped_residuals(
+            bones, weights.weights[entries], points, rows[:, 0:3], rows[:, 3:6]
+        )
+
+    lengths = np.linalg.norm(rows[:, 3:6] - rows[:, 0:3], axis=1)
+    shifts = np.linalg.norm(rows[:, 0:3] + rows[:, 3:6] - original[:, 0:3] - original[:, 3:6], axis=1) / 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        distances, behind, past = (sums[:, 1:] / sums[:, :1]).T
+        scale = np.where(lengths > 0, lengths, np.nan)
+        flags = {
+            'distance': Bone_math.outliers(distances / scale, factor, floor),
+            'outside': behind + past > outside,
+            'shift': Bone_math.outliers(shifts / scale, factor, floor),
+        }
+
+    def value(number):
+        return float(number) if np.isfinite(number) else None
+
+    bones = []
+    for i, name in enumerate(names):
+        bones.append({
+            'bone': name,
+            'weight': float(sums[i, 0]),
+            'length': float(lengths[i]),
+            'distance': value(distances[i]),
+            'behind': value(behind[i]),
+            'past': value(past[i]),
+            'shift': float(shifts[i]),
+            'flags': [flag for flag, marked in flags.items() if marked[i]] if sums[i, 0] else ['no weights'],
+        })
+    return {'bones': bones, 'outliers': [bone['bone'] for bone in bones if bone['flags']]}
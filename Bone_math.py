@@ -0,0 +1,399 @@
+"""
+Array math shared by "Adjust Bone to Shape" and "Bone Weight Alignment".
+
+NumPy only. Takes and returns arrays, never a Blender object: Bone_core reads
+the meshes and bones into arrays and calls this. Install it next to the
+add-on files with Bone_core.py.
+"""
+
+import hashlib
+
+import numpy as np
+
+def to_world(coords, matrix):
+    # matrix_world applied as one matrix multiply
+    matrix = np.asarray(matrix, dtype=np.float64)
+    return coords @ matrix[:3, :3].T + matrix[:3, 3]
+
+class RunningCentroid:
+    # Sum(w * p) and sum(w) of one group, updated only for the members whose
+    # weight changed since the previous call
+    def __init__(self):
+        self.indices = None
+        self.points = None
+
+    def update(self, indices, points, weights):
+        # Members (vertex indices), their points and weights. Returns how
+        # many vertices were added to the sums
+        if (self.points is None or not np.array_equal(indices, self.indices)
+                or not np.array_equal(points, self.points)):
+            # Moved geometry or other members, start over
+            self.indices = indices
+            self.points = points
+            self.weights = weights.copy()
+            self.weighted_sum = weights @ points
+            self.total = float(weights.sum())
+            return len(weights)
+
+        changed = np.flatnonzero(weights != self.weights)
+        if len(changed):
+            delta = weights[changed] - self.weights[changed]
+            self.weighted_sum += delta @ points[changed]
+            self.total += float(delta.sum())
+            self.weights[changed] = weights[changed]
+        return len(changed)
+
+    @property
+    def center(self):
+        if self.total <= 0:
+            return None
+        return self.weighted_sum / self.total
+
+def weighted_centroid(points, weights):
+    # Returns (center, total_weight), center is the origin if there is no weight
+    total_weight = float(weights.sum())
+    if not total_weight:
+        return np.zeros(3), 0.0
+    return weights @ points / total_weight, total_weight
+
+def geometric_median(points, weights, iterations=50, tolerance=1e-7):
+    # Weighted Weiszfeld iteration started from the weighted mean
+    center, total_weight = weighted_centroid(points, weights)
+    if not total_weight:
+        return center, total_weight
+    for _ in range(iterations):
+        distances = np.maximum(np.linalg.norm(points - center, axis=1), 1e-12)
+        inverse = weights / distances
+        previous, center = center, inverse @ points / inverse.sum()
+        if np.linalg.norm(center - previous) <= tolerance:
+            break
+    return center, total_weight
+
+def robust_centroid(points, weights, options):
+    # options.estimator: MEAN, THRESHOLD (weights under min_weight dropped),
+    # TOP_K (top_k heaviest vertices), TRIMMED (trim fraction of the vertices
+    # farthest from the mean dropped) or MEDIAN (geometric median)
+    estimator = options.estimator
+    if estimator == 'THRESHOLD':
+        keep = weights >= options.min_weight
+        points, weights = points[keep], weights[keep]
+    elif estimator == 'TOP_K' and len(weights) > options.top_k:
+        keep = np.argpartition(weights, -options.top_k)[-options.top_k:]
+        points, weights = points[keep], weights[keep]
+    elif estimator == 'TRIMMED' and len(weights):
+        center, total_weight = weighted_centroid(points, weights)
+        count = max(len(weights) - int(len(weights) * options.trim), 1)
+        if total_weight and count < len(weights):
+            distances = np.linalg.norm(points - center, axis=1)
+            keep = np.argpartition(distances, count - 1)[:count]
+            points, weights = points[keep], weights[keep]
+    elif estimator == 'MEDIAN':
+        return geometric_median(points, weights, options.median_iterations)
+
+    return weighted_centroid(points, weights)
+
+def merge_centroids(entries):
+    # One centroid from the (center, total weight) of each mesh
+    total = sum(float(weight) for _, weight in entries)
+    if not total:
+        return np.zeros(3), 0.0
+    return sum(np.asarray(center) * weight for center, weight in entries) / total, total
+
+def center_segment(head, tail, center):
+    # Moves the segment so its middle lands on center, keeping direction and length
+    head = np.asarray(head, dtype=np.float64)
+    tail = np.asarray(tail, dtype=np.float64)
+    offset = np.asarray(center, dtype=np.float64) - (head + tail) / 2
+    return head + offset, tail + offset
+
+def set_length(head, tail, length):
+    # Tail moved along the bone so it has this length, as EditBone.length does
+    head = np.asarray(head, dtype=float)
+    direction = np.asarray(tail, dtype=float) - head
+    norm = np.linalg.norm(direction)
+    if not norm:
+        return head, head + direction
+    return head, head + direction * (length / norm)
+
+def fit_segment(head, tail, length, anchor='HEAD'):
+    # Same direction with this length, about the head, the middle or the tail
+    head = np.asarray(head, dtype=float)
+    tail = np.asarray(tail, dtype=float)
+    direction = tail - head
+    norm = np.linalg.norm(direction)
+    if not norm:
+        return head, tail
+    direction *= length / norm
+    if anchor == 'HEAD':
+        return head, head + direction
+    if anchor == 'TAIL':
+        return tail - direction, tail
+    middle = (head + tail) / 2
+    return middle - direction / 2, middle + direction / 2
+
+def weighted_quantiles(values, weights, quantiles):
+    # Values where the cumulative weight in value order first reaches each
+    # quantile (fractions of the total weight)
+    order = np.argsort(values)
+    cumulative = np.cumsum(weights[order])
+    ranks = np.searchsorted(cumulative, np.asarray(quantiles) * cumulative[-1])
+    return values[order[np.minimum(ranks, len(values) - 1)]]
+
+def extent_length(points, weights, direction, percentile=0.05):
+    # Spread of the weighted points along direction between the percentile
+    # and 1 - percentile of their weight, None without weight or spread
+    norm = np.linalg.norm(direction)
+    if not norm or not len(weights) or weights.sum() <= 0:
+        return None
+    projections = points @ (np.asarray(direction, dtype=float) / norm)
+    low, high = weighted_quantiles(projections, weights, (percentile, 1 - percentile))
+    return float(high - low) if high > low else None
+
+def roll_axes(head, tail):
+    # X and Z axes of the bone at roll 0, Blender's vec_roll_to_mat3
+    y = np.asarray(tail, dtype=float) - np.asarray(head, dtype=float)
+    y = y / np.linalg.norm(y)
+    x, _, z = y
+    theta = 1 + y[1]
+    theta_alt = x * x + z * z
+    if theta <= 6.1e-3 and theta_alt <= 2.5e-4 ** 2:
+        # Pointing down -Y
+        return np.array([-1.0, 0.0, 0.0]), np.array([0.0, 0.0, 1.0])
+    if theta <= 6.1e-3:
+        theta = theta_alt * 0.5 + theta_alt * theta_alt * 0.125
+    x_axis = np.array([1 - x * x / theta, -x, -x * z / theta])
+    z_axis = np.array([-x * z / theta, -z, 1 - z * z / theta])
+    return x_axis, z_axis
+
+def bone_z_axis(head, tail, roll):
+    x_axis, z_axis = roll_axes(head, tail)
+    return z_axis * np.cos(roll) + x_axis * np.sin(roll)
+
+def roll_to_vector(head, tail, vector, roll=0.0):
+    # Roll that points the Z axis at vector, as EditBone.align_roll. The old
+    # roll is kept for zero length bones or a vector along the bone
+    direction = np.asarray(tail, dtype=float) - np.asarray(head, dtype=float)
+    length = np.linalg.norm(direction)
+    vector = np.asarray(vector, dtype=float)
+    vector = vector / (np.linalg.norm(vector) or 1.0)
+    if length <= 1e-7 or abs(np.dot(vector, direction / length)) >= 1 - 1e-7:
+        return roll
+    x_axis, z_axis = roll_axes(head, tail)
+    return float(np.arctan2(np.dot(vector, x_axis), np.dot(vector, z_axis)))
+
+def align_row(row, options, center=None, head_pos=None, tail_pos=None, segment=None, extent=None):
+    # One bone as a [head, tail, roll] row, same steps as the alignment
+    # operators: alignment (or principal axis), between groups, length.
+    # extent is the (points, weights) of the group for fit_length. Parent
+    # connect needs the parent and is left to the caller
+    head = np.array(row[0:3], dtype=float)
+    tail = np.array(row[3:6], dtype=float)
+    roll = float(row[6])
+    initial_length = np.linalg.norm(tail - head)
+
+    if options.align_bone and segment is not None:
+        new_head, new_tail, secondary = (np.asarray(vector, dtype=float) for vector in segment)
+        if np.linalg.norm(new_tail - new_head) <= 1e-6:
+            # No extent (a single vertex), keeps direction and length
+            head, tail = center_segment(head, tail, new_head)
+        else:
+            # Keeps the bone pointing the way it did
+            if np.dot(new_tail - new_head, tail - head) < 0:
+                new_head, new_tail = new_tail, new_head
+            head, tail = new_head, new_tail
+        if options.orient_roll:
+            if np.dot(secondary, bone_z_axis(head, tail, roll)) < 0:
+                secondary = -secondary
+            roll = roll_to_vector(head, tail, secondary, roll)
+    elif options.align_bone and center is not None:
+        if options.alignment == 'HEAD':
+            head = np.asarray(center, dtype=float)
+        if options.alignment == 'TAIL':
+            tail = np.asarray(center, dtype=float)
+        if options.alignment in ('CENTER', 'VOLUME'):
+            head, tail = center_segment(head, tail, center)
+
+    if head_pos is not None:
+        head = np.asarray(head_pos, dtype=float)
+    if tail_pos is not None:
+        tail = np.asarray(tail_pos, dtype=float)
+
+    length = None
+    if options.fit_length and extent is not None:
+        length = extent_length(*extent, tail - head, options.length_percentile)
+    if length is not None:
+        # Resized about what the alignment placed
+        if head_pos is not None or (segment is None and options.alignment == 'HEAD'):
+            anchor = 'HEAD'
+        elif tail_pos is not None or (segment is None and options.alignment == 'TAIL'):
+            anchor = 'TAIL'
+        else:
+            anchor = 'CENTER'
+        head, tail = fit_segment(head, tail, length, anchor)
+    elif options.preserve_length:
+        head, tail = set_length(head, tail, initial_length)
+
+    return np.concatenate([head, tail, [roll]])
+
+def mirror_row(row):
+    # The .L/.R counterpart of a [head, tail, roll] row
+    row = np.asarray(row, dtype=float)
+    return np.concatenate([mirror_x(row[0:3]), mirror_x(row[3:6]), [-row[6]]])
+
+def fingerprint(*values):
+    # Digest of arrays and strings. Arrays hash their type and shape too, so
+    # the same bytes in another layout differ
+    digest = hashlib.blake2b(digest_size=16)
+    for value in values:
+        if isinstance(value, str):
+            digest.update(b's' + value.encode())
+            continue
+        value = np.ascontiguousarray(value)
+        digest.update(repr((value.dtype.str, value.shape)).encode())
+        digest.update(value.tobytes())
+    return digest.hexdigest()
+
+def grouped_centroids(groups, weights, points, count):
+    # Weighted mean of every group in one sweep: one (group, weight, point)
+    # per deform entry, rows of the result indexed by group
+    totals = np.bincount(groups, weights=weights, minlength=count)
+    sums = np.stack([
+        np.bincount(groups, weights=weights * points[:, axis], minlength=count)
+        for axis in range(3)
+    ], axis=1)
+    centers = np.zeros((count, 3))
+    np.divide(sums, totals[:, None], out=centers, where=totals[:, None] > 0)
+    return centers, totals
+
+def grouped_segments(groups, weights, points, indptr, count):
+    # principal_segment of every group from one sweep over entries sorted by
+    # group (indptr as in MeshWeights): sum(w), sum(w * p) and
+    # sum(w * p * p^T) per group, then one batched eigen decomposition.
+    # Returns heads, tails, secondaries and totals
+    def per_group(values):
+        return np.bincount(groups, weights=weights * values, minlength=count)
+
+    totals = np.bincount(groups, weights=weights, minlength=count)
+    safe = np.where(totals > 0, totals, 1.0)
+    means = np.stack([per_group(points[:, a]) for a in range(3)], axis=1) / safe[:, None]
+    covariances = np.empty((count, 3, 3))
+    for a in range(3):
+        for b in range(a, 3):
+            second = per_group(points[:, a] * points[:, b]) / safe
+            covariances[:, a, b] = covariances[:, b, a] = second - means[:, a] * means[:, b]
+    values, vectors = np.linalg.eigh(covariances)
+    axes, secondaries = vectors[:, :, 2], vectors[:, :, 1]
+
+    # Extent along each group's axis, entries without weight do not count
+    projections = np.einsum('ij,ij->i', points - means[groups], axes[groups])
+    positive = weights > 0
+    starts = indptr[:-1]
+    filled = np.flatnonzero(indptr[1:] > starts)
+    low = np.zeros(count)
+    high = np.zeros(count)
+    if len(filled):
+        low[filled] = np.minimum.reduceat(np.where(positive, projections, np.inf), starts[filled])
+        high[filled] = np.maximum.reduceat(np.where(positive, projections, -np.inf), starts[filled])
+        empty = ~np.isfinite(low)
+        low[empty] = high[empty] = 0.0
+
+    heads = means + axes * low[:, None]
+    tails = means + axes * high[:, None]
+    return heads, tails, secondaries, totals
+
+def grouped_residuals(groups, weights, points, heads, tails):
+    # How far the entries of every group lie from its bone segment, rows of
+    # heads/tails indexed by group. Returns per group sum(w), sum(w *
+    # distance to the segment), the weight behind the head and past the tail
+    count = len(heads)
+    axes = tails - heads
+    squared = np.einsum('ij,ij->i', axes, axes)
+    offsets = points - heads[groups]
+    factors = np.einsum('ij,ij->i', offsets, axes[groups]) / np.where(squared > 0, squared, 1.0)[groups]
+    closest = axes[groups] * np.clip(factors, 0.0, 1.0)[:, None]
+    distances = np.linalg.norm(offsets - closest, axis=1)
+
+    def per_group(values):
+        return np.bincount(groups, weights=values, minlength=count)
+
+    return np.stack([
+        per_group(weights),
+        per_group(weights * distances),
+        per_group(weights * (factors < 0)),
+        per_group(weights * (factors > 1)),
+    ], axis=1)
+
+def outliers(values, factor=3.0, floor=0.0):
+    # Values over the median by more than factor scaled median absolute
+    # deviations, which the outliers themselves barely move. NaN is never one.
+    # floor is the least deviation counted, when most values are equal the
+    # median deviation is 0 and any noise would stand out
+    values = np.asarray(values, dtype=float)
+    if not np.isfinite(values).any():
+        return np.zeros(len(values), dtype=bool)
+    median = np.nanmedian(values)
+    spread = max(np.nanmedian(np.abs(values - median)) * 1.4826, floor)
+    with np.errstate(invalid='ignore'):
+        return values > median + factor * spread + 1e-9
+
+def principal_segment(points, weights):
+    # Segment along the main axis of the weighted points covering their
+    # extent, plus the secondary axis for the roll. Axis signs are arbitrary
+    center, total_weight = weighted_centroid(points, weights)
+    if not total_weight:
+        return None
+    offsets = points - center
+    covariance = (offsets * weights[:, None]).T @ offsets / total_weight
+    values, vectors = np.linalg.eigh(covariance)
+    axis, secondary = vectors[:, 2], vectors[:, 1]
+    # Extent of the weighted vertices only
+    projections = offsets[weights > 0] @ axis
+    return center + axis * projections.min(), center + axis * projections.max(), secondary
+
+def mirror_x(points):
+    # Reflection across the YZ plane, the one .L/.R bones mirror on
+    return np.asarray(points, dtype=float) * (-1.0, 1.0, 1.0)
+
+def average_mirrored(point, other):
+    # Point averaged with the mirror of its counterpart, either may be None
+    if other is None:
+        return None if point is None else np.asarray(point, dtype=float)
+    if point is None:
+        return mirror_x(other)
+    return (np.asarray(point, dtype=float) + mirror_x(other)) / 2
+
+def average_segments(segment, other):
+    # Same for principal_segment results, whose axis signs are arbitrary
+    if other is None:
+        return segment
+    other = tuple(mirror_x(vector) for vector in other)
+    if segment is None:
+        return other
+    head, tail, secondary = (np.asarray(vector, dtype=float) for vector in segment)
+    other_head, other_tail, other_secondary = other
+    if np.dot(other_tail - other_head, tail - head) < 0:
+        other_head, other_tail = other_tail, other_head
+    if np.dot(other_secondary, secondary) < 0:
+        other_secondary = -other_secondary
+    return (head + other_head) / 2, (tail + other_tail) / 2, (secondary + other_secondary) / 2
+
+def average_extents(extent, other):
+    # Points and weights of both sides in one cloud, the other side mirrored
+    if other is None:
+        return extent
+    points, weights = other
+    if extent is None:
+        return mirror_x(points), weights
+    return np.concatenate([extent[0], mirror_x(points)]), np.concatenate([extent[1], weights])
+
+def fibonacci_sphere(count):
+    # Evenly spread unit directions
+    steps = np.arange(count) + 0.5
+    z = 1 - 2 * steps / count
+    radius = np.sqrt(1 - z * z)
+    angle = np.pi * (1 + 5 ** 0.5) * steps
+    return np.stack([radius * np.cos(angle), radius * np.sin(angle), z], axis=1)
+
+def segment_samples(count):
+    # Factors of evenly spaced points along a segment, ends excluded
+    return (np.arange(count) + 0.5) / count
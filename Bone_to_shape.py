@@ -9,9 +9,19 @@ bl_info = {
     "category" : "Rigging"
 }
 
+import json
+import time
+
 import bpy
+import gpu
+from bpy.app.handlers import persistent
+from gpu_extras.batch import batch_for_shader
 from mathutils import Vector
 
+import Bone_align
+import Bone_core
+import Bone_math
+
 def filter_object_by_bone(self, obj):
     return (
         obj.type == 'MESH' and 
@@ -20,6 +30,10 @@ def filter_object_by_bone(self, obj):
         obj.parent == bpy.context.active_object
     )
 
+def update_blend(self, context):
+    if context.object and context.mode == 'EDIT_ARMATURE':
+        Bone_core.blend_bones(context.object.data, self.head_blend, self.tail_blend)
+
 class BoneToShapeProps(bpy.types.PropertyGroup):
     custom_groups: bpy.props.BoolProperty(name="Custom Group", options=set())
     target: bpy.props.PointerProperty(
@@ -33,7 +47,8 @@ class BoneToShapeProps(bpy.types.PropertyGroup):
         items = (
             ('HEAD', "Head", ""),
             ('CENTER', "Center", ""),
-            ('TAIL', "Tail", "")
+            ('TAIL', "Tail", ""),
+            ('VOLUME', "Volume", "Centers the bone inside the mesh volume with rays")
         ),
         default = 'CENTER'
     )
@@ -47,6 +62,14 @@ class BoneToShapeProps(bpy.types.PropertyGroup):
         options=set(),
         description='Prevents the bone from changing size'
     )
+    fit_length: bpy.props.BoolProperty(
+        options=set(),
+        description='Sizes the bone to the extent of its vertex group along the bone'
+    )
+    length_percentile: bpy.props.FloatProperty(
+        default=0.05, min=0.0, max=0.45, subtype='FACTOR', options=set(),
+        description='Fraction of the group weight left out at each end of the bone'
+    )
     parent_connect: bpy.props.BoolProperty(
         options=set(), 
         description='Only works if has a parent and related by keep offset'
@@ -59,6 +82,237 @@ class BoneToShapeProps(bpy.types.PropertyGroup):
         options=set(), 
         description='Aligns the tail between two vertex groups'
     )
+    use_evaluated: bpy.props.BoolProperty(
+        options=set(),
+        description='Uses the mesh as shown, with modifiers and shape keys'
+    )
+    all_meshes: bpy.props.BoolProperty(
+        options=set(),
+        description='Combines the group of every mesh parented to the armature, not only the target'
+    )
+    orient: bpy.props.BoolProperty(
+        options=set(),
+        description='Points the bone along the main axis of its vertex group and fits head and tail to its extent'
+    )
+    orient_roll: bpy.props.BoolProperty(
+        options=set(),
+        description='Rolls the bone towards the second axis of its vertex group'
+    )
+    estimator: bpy.props.EnumProperty(
+        items = (
+            ('MEAN', "Mean", "Weighted mean of the whole group"),
+            ('THRESHOLD', "Threshold", "Ignores vertices under a minimum weight"),
+            ('TOP_K', "Top K", "Only the heaviest vertices"),
+            ('TRIMMED', "Trimmed", "Drops the vertices farthest from the mean"),
+            ('MEDIAN', "Median", "Weighted geometric median")
+        ),
+        default = 'MEAN',
+        options=set()
+    )
+    min_weight: bpy.props.FloatProperty(
+        default=0.1, min=0.0, max=1.0, subtype='FACTOR', options=set(),
+        description='Vertices under this weight are ignored'
+    )
+    top_k: bpy.props.IntProperty(
+        default=100, min=1, options=set(),
+        description='How many of the heaviest vertices are used'
+    )
+    trim: bpy.props.FloatProperty(
+        default=0.1, min=0.0, max=0.9, subtype='FACTOR', options=set(),
+        description='Fraction of the vertices farthest from the mean that is dropped'
+    )
+    median_iterations: bpy.props.IntProperty(
+        default=50, min=1, max=1000, options=set(),
+        description='Maximum Weiszfeld iterations'
+    )
+    ray_count: bpy.props.IntProperty(
+        default=128, min=4, max=10000, options=set(),
+        description='Rays cast from each sample point'
+    )
+    ray_samples: bpy.props.IntProperty(
+        default=5, min=1, max=64, options=set(),
+        description='Points along the bone the rays start from'
+    )
+    ray_distance: bpy.props.FloatProperty(
+        default=1.0, min=0.001, subtype='DISTANCE', options=set(),
+        description='Maximum ray length'
+    )
+    head_blend: bpy.props.FloatProperty(
+        default=1.0, min=0.0, max=1.0, subtype='FACTOR', options=set(),
+        update=update_blend,
+        description='Moves the heads of the aligned bones from the original (0) to the aligned (1) position'
+    )
+    tail_blend: bpy.props.FloatProperty(
+        default=1.0, min=0.0, max=1.0, subtype='FACTOR', options=set(),
+        update=update_blend,
+        description='Moves the tails of the aligned bones from the original (0) to the aligned (1) position'
+    )
+    batch_selected: bpy.props.BoolProperty(
+        options=set(),
+        description='Align All only aligns the selected bones'
+    )
+    mirror: bpy.props.EnumProperty(
+        items = (
+            ('NONE', "Both Sides", "Every bone is computed"),
+            ('MIRROR', "Mirror", "Computes one side of each .L/.R pair and mirrors it across X"),
+            ('AVERAGE', "Average", "Averages both sides of each .L/.R pair, then mirrors the result")
+        ),
+        default = 'NONE',
+        options=set()
+    )
+
+class AlignOptions:
+    # Operator props shared by the single bone and batch operators, the
+    # names of Bone_align.OPTIONS
+    preserve_length: bpy.props.BoolProperty()
+    fit_length: bpy.props.BoolProperty()
+    length_percentile: bpy.props.FloatProperty(default=0.05, min=0.0, max=0.45)
+    parent_connect: bpy.props.BoolProperty()
+    align_bone: bpy.props.BoolProperty()
+    head_between: bpy.props.BoolProperty()
+    tail_between: bpy.props.BoolProperty()
+    head_group: bpy.props.StringProperty()
+    tail_group: bpy.props.StringProperty()
+    alignment: bpy.props.EnumProperty(
+        items = (
+            ('HEAD', "Head", ""),
+            ('CENTER', "Center", ""),
+            ('TAIL', "Tail", ""),
+            ('VOLUME', "Volume", "Centers the bone inside the mesh volume with rays")
+        ),
+        default = 'CENTER'
+    )
+    use_evaluated: bpy.props.BoolProperty()
+    all_meshes: bpy.props.BoolProperty()
+    orient: bpy.props.BoolProperty()
+    orient_roll: bpy.props.BoolProperty()
+    estimator: bpy.props.EnumProperty(
+        items = (
+            ('MEAN', "Mean", ""),
+            ('THRESHOLD', "Threshold", ""),
+            ('TOP_K', "Top K", ""),
+            ('TRIMMED', "Trimmed", ""),
+            ('MEDIAN', "Median", "")
+        ),
+        default = 'MEAN'
+    )
+    min_weight: bpy.props.FloatProperty(default=0.1, min=0.0, max=1.0)
+    top_k: bpy.props.IntProperty(default=100, min=1)
+    trim: bpy.props.FloatProperty(default=0.1, min=0.0, max=0.9)
+    median_iterations: bpy.props.IntProperty(default=50, min=1)
+    ray_count: bpy.props.IntProperty(default=128, min=4)
+    ray_samples: bpy.props.IntProperty(default=5, min=1)
+    ray_distance: bpy.props.FloatProperty(default=1.0, min=0.001)
+    mirror: bpy.props.EnumProperty(
+        items = (
+            ('NONE', "Both Sides", ""),
+            ('MIRROR', "Mirror", ""),
+            ('AVERAGE', "Average", "")
+        ),
+        default = 'NONE'
+    )
+
+def set_align_options(op, bs_props):
+    op.alignment = bs_props.alignment
+    op.align_bone = bs_props.align_bone
+    op.preserve_length = bs_props.preserve_length
+    op.fit_length = bs_props.fit_length
+    op.length_percentile = bs_props.length_percentile
+    op.parent_connect = bs_props.parent_connect
+    op.head_between = bs_props.head_between
+    op.tail_between = bs_props.tail_between
+    op.head_group = bs_props.head_group
+    op.tail_group = bs_props.tail_group
+    op.use_evaluated = bs_props.use_evaluated
+    op.all_meshes = bs_props.all_meshes
+    op.orient = bs_props.orient
+    op.orient_roll = bs_props.orient_roll
+    op.estimator = bs_props.estimator
+    op.min_weight = bs_props.min_weight
+    op.top_k = bs_props.top_k
+    op.trim = bs_props.trim
+    op.median_iterations = bs_props.median_iterations
+    op.ray_count = bs_props.ray_count
+    op.ray_samples = bs_props.ray_samples
+    op.ray_distance = bs_props.ray_distance
+    op.mirror = bs_props.mirror
+
+class PanelState:
+    # What the panel shows for one rig, active bone and target, resolved once
+    # instead of on every redraw. Stats only come from caches, draw never
+    # reads mesh data or the snapshot ID properties
+    def __init__(self, key, armature, bone, target, bs_props):
+        self.key = key
+        self.snapshots = Bone_core.snapshots(armature)[::-1]
+        self.bone_name = bone.name
+        self.bone_group = None
+        self.group = None
+        self.has_groups = False
+        self.stats = None
+        if target is None:
+            return
+
+        groups = target.vertex_groups
+        self.has_groups = bool(groups)
+        if bone.name in groups:
+            self.bone_group = bone.name
+        name = bs_props.vertex_group if bs_props.custom_groups else bone.name
+        if name in groups:
+            self.group = name
+
+        # Group size from the weight index if an alignment already built it
+        lines = []
+        weights = Bone_core.cached_weights(target, bs_props.use_evaluated)
+        if self.group and weights is not None:
+            indices, _ = weights.group(groups[self.group].index)
+            lines.append('%d vertices' % len(indices))
+        center = last_centers.get((target.name, self.group))
+        if center is not None:
+            lines.append('Centroid %.3f, %.3f, %.3f' % tuple(center))
+        self.stats = lines or None
+
+# Last centroid per (object name, group name), written by bs.to_shape
+last_centers = {}
+
+# Last bs.quality_report per armature data name, dropped by a new alignment
+quality_reports = {}
+
+# Flagged bones listed in the panel, the rest are in the export
+QUALITY_LINES = 10
+
+# PanelState of the last redraw, dropped by the handlers and operators
+_panel_state = None
+
+def panel_state(rig, bs_props):
+    global _panel_state
+    bone = rig.data.edit_bones.active
+    target = bs_props.target
+    key = (
+        rig.name, bone.name, target.name if target else '',
+        bs_props.custom_groups, bs_props.vertex_group, bs_props.use_evaluated
+    )
+    if _panel_state is None or _panel_state.key != key:
+        _panel_state = PanelState(key, rig.data, bone, target, bs_props)
+    return _panel_state
+
+def drop_panel_state(*args):
+    global _panel_state
+    _panel_state = None
+
+@persistent
+def undo_panel_state(*args):
+    # Undo can bring back or drop snapshots, they live on the armature
+    drop_panel_state()
+
+def fill_from_panel(op, context):
+    # Operators called from the panel take the bone, target and options here
+    bs_props = context.scene.bs_props
+    if hasattr(op, 'bone_name'):
+        op.bone_name = context.object.data.edit_bones.active.name
+        op.vertex_group = bs_props.vertex_group
+        op.custom_groups = bs_props.custom_groups
+    op.object_name = bs_props.target.name
+    set_align_options(op, bs_props)
 
 class BoneToShapePanel(bpy.types.Panel):
     bl_label = "Bone to Shape"
@@ -73,16 +327,35 @@ class BoneToShapePanel(bpy.types.Panel):
             context.object is not None and context.mode == 'EDIT_ARMATURE'
         )
         
-    def call_operator(self, layout, bs_props, bone):
+    def call_operator(self, layout, bs_props):
         # Align Operator Options props
         col = layout.column(heading='Options')
         col.use_property_decorate = False
         col.use_property_split = True
         col.prop(bs_props, 'align_bone', text='Align Bone')
         col.prop(bs_props, 'preserve_length', text='Preserve Length')
+        col.prop(bs_props, 'fit_length', text='Fit Length')
+        if bs_props.fit_length:
+            col.prop(bs_props, 'length_percentile', text='Percentile')
         col.prop(bs_props, 'parent_connect', text='Parent Connect')
         col.prop(bs_props, 'head_between', text='Head Between')
         col.prop(bs_props, 'tail_between', text='Tail Between')
+        col.prop(bs_props, 'use_evaluated', text='Evaluated Mesh')
+        col.prop(bs_props, 'orient', text='Principal Axis')
+        if bs_props.orient:
+            col.prop(bs_props, 'orient_roll', text='Roll From Group')
+
+        # Centroid estimator
+        row = layout.row(align=True)
+        row.prop(bs_props, 'estimator', text='')
+        if bs_props.estimator == 'THRESHOLD':
+            row.prop(bs_props, 'min_weight', text='Min')
+        if bs_props.estimator == 'TOP_K':
+            row.prop(bs_props, 'top_k', text='K')
+        if bs_props.estimator == 'TRIMMED':
+            row.prop(bs_props, 'trim', text='Trim')
+        if bs_props.estimator == 'MEDIAN':
+            row.prop(bs_props, 'median_iterations', text='Iterations')
 
         # Head group
         if bs_props.head_between:
@@ -99,31 +372,37 @@ class BoneToShapePanel(bpy.types.Panel):
             )
 
         # Align Operator
-        if bs_props.align_bone:
+        if bs_props.align_bone and not bs_props.orient:
             layout.prop(bs_props, 'alignment', expand=True)
+            if bs_props.alignment == 'VOLUME':
+                row = layout.row(align=True)
+                row.prop(bs_props, 'ray_count', text='Rays')
+                row.prop(bs_props, 'ray_samples', text='Samples')
+                row.prop(bs_props, 'ray_distance', text='Distance')
 
-        op = layout.operator('bs.to_shape')
-        op.bone_name = bone.name
-        op.object_name = bs_props.target.name
-        op.vertex_group = bs_props.vertex_group
-        op.custom_groups = bs_props.custom_groups
-        op.alignment = bs_props.alignment
-        op.align_bone = bs_props.align_bone
-        op.preserve_length = bs_props.preserve_length
-        op.parent_connect = bs_props.parent_connect
-        op.head_between = bs_props.head_between
-        op.tail_between = bs_props.tail_between
-        op.head_group = bs_props.head_group
-        op.tail_group = bs_props.tail_group
+        # Props are filled in invoke, not on every redraw
+        layout.operator('bs.to_shape')
+
+        # Live preview toggle
+        if previewable(bs_props):
+            layout.operator(
+                'bs.live_preview',
+                text='Stop Preview' if live_preview else 'Live Preview',
+                depress=live_preview is not None
+            )
     
+    def draw_stats(self, layout, state):
+        if state.stats:
+            col = layout.column(align=True)
+            col.active = False
+            for line in state.stats:
+                col.label(text=line)
+
     def draw(self, context):
         rig = context.object
-        curr_bone = rig.data.edit_bones.active
         bs_props = context.scene.bs_props
-        bone_has_group = False
-        
-        if bs_props.target:
-            bone_has_group = bs_props.target.vertex_groups.get(curr_bone.name, None)
+        state = panel_state(rig, bs_props)
+        bone_has_group = state.bone_group
 
         layout = self.layout
         box = layout.box()
@@ -139,7 +418,7 @@ class BoneToShapePanel(bpy.types.Panel):
             row.alert = True
 
         # Bone Info label
-        row.label(text=curr_bone.name, icon='BONE_DATA')
+        row.label(text=state.bone_name, icon='BONE_DATA')
         
         # No animation
         layout.use_property_decorate = False
@@ -157,11 +436,12 @@ class BoneToShapePanel(bpy.types.Panel):
             
             # Groups ON option
             row.prop(bs_props, 'custom_groups', event=False, text='Use Custom Group')
+            row.prop(bs_props, 'all_meshes', text='All Meshes')
             
             if bs_props.custom_groups:
                 box = box.box()
                 box.active = False
-                if bs_props.target.vertex_groups:
+                if state.has_groups:
                     box.active = True
                     
                     # Groups search
@@ -178,50 +458,118 @@ class BoneToShapePanel(bpy.types.Panel):
         
         # Operator
         if bs_props.custom_groups:
-            exists = False
-            if bs_props.target:
-                exists = bs_props.target.vertex_groups.get(bs_props.vertex_group, None)
-            if exists:
+            if state.group:
+                self.draw_stats(layout, state)
                 # Operator
-                self.call_operator(layout, bs_props, curr_bone)
+                self.call_operator(layout, bs_props)
         else:
             if bone_has_group:
                 box = layout.box()
                 row = box.row()
                 row.alignment = 'CENTER'
                 # Vertex group info label
-                row.label(text=bone_has_group.name, icon='GROUP_VERTEX')
+                row.label(text=bone_has_group, icon='GROUP_VERTEX')
+                self.draw_stats(box, state)
                 # Operator
-                self.call_operator(layout, bs_props, curr_bone)
+                self.call_operator(layout, bs_props)
+
+        # Whole rig
+        if bs_props.target:
+            box = layout.box()
+            row = box.row()
+            row.prop(bs_props, 'batch_selected', text='Selected Only')
+            row.operator('bs.to_shape_batch')
+            box.row().prop(bs_props, 'mirror', expand=True)
+
+        # Blend between original and aligned
+        entry = Bone_core.endpoints(rig.data, create=False)
+        if entry is not None and entry.names:
+            col = layout.column(align=True)
+            col.prop(bs_props, 'head_blend', text='Head', slider=True)
+            col.prop(bs_props, 'tail_blend', text='Tail', slider=True)
+
+        # Fit of the aligned bones
+        if bs_props.target and entry is not None and entry.previous:
+            report = quality_reports.get(rig.data.name)
+            box = layout.box()
+            row = box.row()
+            row.label(text='Quality', icon='VIEWZOOM')
+            row.operator('bs.quality_report', text='', icon='FILE_REFRESH')
+            if report:
+                row.operator('bs.quality_export', text='', icon='EXPORT')
+                flagged = [bone for bone in report['bones'] if bone['flags']]
+                col = box.column(align=True)
+                col.label(text='%d bones, %d flagged' % (len(report['bones']), len(flagged)))
+                for bone in flagged[:QUALITY_LINES]:
+                    row = col.row()
+                    row.alert = True
+                    row.label(text='%s: %s' % (bone['bone'], ', '.join(bone['flags'])), icon='ERROR')
+                if len(flagged) > QUALITY_LINES:
+                    col.label(text='%d more in the export' % (len(flagged) - QUALITY_LINES))
+
+        # Snapshots
+        box = layout.box()
+        row = box.row()
+        row.label(text='Backups', icon='FILE_BACKUP')
+        row.operator('bs.snapshot', text='', icon='ADD')
+        for snapshot_id, label, count in state.snapshots:
+            row = box.row(align=True)
+            row.label(text='%d. %s (%d)' % (snapshot_id, label, count))
+            op = row.operator('bs.snapshot_restore', text='', icon='LOOP_BACK')
+            op.snapshot_id = snapshot_id
+            op = row.operator('bs.snapshot_restore', text='', icon='X')
+            op.snapshot_id = snapshot_id
+            op.remove = True
+
+        # Profiling, last run of any alignment operator
+        profiler = Bone_core.profiler
+        box = layout.box()
+        row = box.row()
+        row.label(text='Profiling', icon='TIME')
+        row.operator(
+            'bs.profile', text='', icon='PAUSE' if profiler.enabled else 'PLAY', depress=profiler.enabled
+        )
+        if profiler.records:
+            row.operator('bs.profile_export', text='', icon='EXPORT')
+            row.operator('bs.profile', text='', icon='TRASH').clear = True
+
+            record = profiler.records[-1]
+            col = box.column(align=True)
+            col.label(text='%s: %.2f ms' % (record['operator'], record['total'] * 1000))
+            for name, seconds in record['phases'].items():
+                col.label(text='%s: %.2f ms' % (name.capitalize(), seconds * 1000))
+            for name, value in record['counts'].items():
+                col.label(text='%s: %d' % (name.capitalize(), value))
+            col.label(text='Cache: %d hits, %d misses' % (record['cache_hits'], record['cache_misses']))
         
 
-class BoneToShapeOP(bpy.types.Operator):
+def record_endpoints(context, armature, names, original, groups=None):
+    # Aligned positions for the blend sliders, which go back to fully aligned.
+    # groups has the vertex groups each bone was fitted to, for the report
+    if not names:
+        # Nothing moved, the sliders keep the previous run
+        return
+    aligned = Bone_core.read_bones(armature.edit_bones)
+    indices = [armature.edit_bones.find(name) for name in names]
+    Bone_core.endpoints(armature).record(names, original[indices, :6], aligned[indices, :6], groups)
+    quality_reports.pop(armature.name, None)
+
+    bs_props = context.scene.bs_props
+    if bs_props.head_blend != 1.0:
+        bs_props.head_blend = 1.0
+    if bs_props.tail_blend != 1.0:
+        bs_props.tail_blend = 1.0
+
+class BoneToShapeOP(AlignOptions, bpy.types.Operator):
     '''Align bones to shape usign vertex groups'''
     bl_idname = "bs.to_shape"
     bl_options = {'REGISTER', 'UNDO_GROUPED'}
     bl_label = "Align"
 
-    o_head: bpy.props.StringProperty()
-    o_tail: bpy.props.StringProperty()
     bone_name: bpy.props.StringProperty()
     object_name: bpy.props.StringProperty()
     vertex_group: bpy.props.StringProperty()
     custom_groups: bpy.props.BoolProperty()
-    preserve_length: bpy.props.BoolProperty()
-    parent_connect: bpy.props.BoolProperty()
-    align_bone: bpy.props.BoolProperty()
-    head_between: bpy.props.BoolProperty()
-    tail_between: bpy.props.BoolProperty()
-    head_group: bpy.props.StringProperty()
-    tail_group: bpy.props.StringProperty()
-    alignment: bpy.props.EnumProperty(
-        items = (
-            ('HEAD', "Head", ""),
-            ('CENTER', "Center", ""),
-            ('TAIL', "Tail", "")
-        ),
-        default = 'CENTER'
-    )
 
     @classmethod
     def poll(cls, context):
@@ -229,155 +577,557 @@ class BoneToShapeOP(bpy.types.Operator):
             context.object is not None and context.mode == 'EDIT_ARMATURE'
         )
         
-    def calc_center(self, object, group):
-        center = [0, 0, 0]
-        total_weight = 0
-        for vert in object.data.vertices:
-            for g in vert.groups:
-                if g.group == group.index:
-                    center = [c + g.weight * v for c, v in zip(center, object.matrix_world @ vert.co)]
-                    total_weight += g.weight
-        if total_weight:
-            center = [c / total_weight for c in center]
-
-        return center
-    
-    def calc_center_between_groups(self, object, group1, group2):
-        center1 = self.calc_center(object, group1)
-        center2 = self.calc_center(object, group2)
-        center_between = [(c1 + c2) / 2 for c1, c2 in zip(center1, center2)]
+    def calc_center(self, targets, group):
+        # None when the estimator leaves no weight
+        center, total_weight = Bone_core.parts_centroid(
+            Bone_align.group_parts(targets, group, self), self
+        )
+        if not total_weight:
+            return None
 
-        return center_between
+        return center.tolist()
     
-    def center_bone(self, bone, center):
-        center = Vector(center)
-        bone_center = (bone.head + bone.tail) / 2 # Centro del hueso
+    def calc_center_between_groups(self, targets, group1, group2):
+        center, total_weight = Bone_core.parts_centroid(Bone_align.group_parts(targets, group1, self), self)
+        other, other_weight = Bone_core.parts_centroid(Bone_align.group_parts(targets, group2, self), self)
+        if not total_weight or not other_weight:
+            return None
 
-        # Direccion del hueso
-        bone_dir = bone.tail - bone.head
-        bone_dir.normalize()
-        
-        # Position
-        head = center - bone_dir * (bone_center - bone.head).length
-        tail = center + bone_dir * (bone.tail - bone_center).length
+        return ((center + other) / 2).tolist()
 
-        return head, tail 
+    def invoke(self, context, event):
+        fill_from_panel(self, context)
+        return self.execute(context)
 
     def execute(self, context):
-        bone = context.object.data.edit_bones[self.bone_name]
+        profiler = Bone_core.profiler
+        profiler.start(self.bl_idname)
+
+        with profiler.phase('group lookup'):
+            bone = context.object.data.edit_bones[self.bone_name]
+            object = context.scene.objects[self.object_name]
+
+            targets = Bone_align.target_objects(context.object, object, self)
+
+            # bone.name if not exist vertex_group
+            if self.custom_groups:
+                group = self.vertex_group
+            else:
+                group = bone.name
+
+        original = Bone_core.read_bones(context.object.data.edit_bones)
+
+        center = head_pos = tail_pos = segment = extent = None
+        empty = False
+        with profiler.phase('centroid'):
+            if self.fit_length:
+                extent = Bone_core.parts_points(Bone_align.group_parts(targets, group, self))
+            if self.align_bone and self.orient:
+                segment = Bone_core.parts_segment(Bone_align.group_parts(targets, group, self))
+            elif self.align_bone:
+                if self.alignment == 'VOLUME':
+                    center = Bone_align.volume_center(object, bone.head, bone.tail, self)
+                else:
+                    center = self.calc_center(targets, group)
+                    empty = center is None
+
+            # Head alignment between
+            if self.head_between:
+                if self.head_group:
+                    if any(self.head_group in target.vertex_groups for target in targets):
+                        head_pos = self.calc_center_between_groups(targets, group, self.head_group)
+                        empty = empty or head_pos is None
+
+            # Tail alignment between
+            if self.tail_between:
+                if self.tail_group:
+                    if any(self.tail_group in target.vertex_groups for target in targets):
+                        tail_pos = self.calc_center_between_groups(targets, group, self.tail_group)
+                        empty = empty or tail_pos is None
+
+        # Nothing to align to, the bone stays where it is
+        if empty or (self.align_bone and self.orient and segment is None):
+            profiler.finish()
+            self.report({'ERROR'}, 'No weight left in "%s" to align to' % group)
+            return {'CANCELLED'}
+
+        Bone_align.align_bone(bone, self, center, head_pos, tail_pos, segment, extent)
+        groups = [group]
+        if head_pos is not None:
+            groups.append(self.head_group)
+        if tail_pos is not None:
+            groups.append(self.tail_group)
+        record_endpoints(context, context.object.data, [bone.name], original, [groups])
+        if center is not None:
+            last_centers[(object.name, group)] = list(center)
+        drop_panel_state()
+
+        Bone_align.count_targets(targets)
+        profiler.finish()
+
+        return {'FINISHED'}
+
+class BoneToShapeBatchOP(AlignOptions, bpy.types.Operator):
+    '''Align every bone that has a vertex group in the target mesh'''
+    bl_idname = "bs.to_shape_batch"
+    bl_options = {'REGISTER', 'UNDO'}
+    bl_label = "Align All"
+
+    object_name: bpy.props.StringProperty()
+    selected_only: bpy.props.BoolProperty()
+    backup: bpy.props.BoolProperty(
+        default=True,
+        description='Takes a snapshot of the rig before aligning'
+    )
+    incremental: bpy.props.BoolProperty(
+        default=True,
+        description='Skips the bones whose groups, mesh, options and position did not change since the last run'
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return (
+            context.object is not None and context.mode == 'EDIT_ARMATURE'
+        )
+
+    def invoke(self, context, event):
+        fill_from_panel(self, context)
+        self.selected_only = context.scene.bs_props.batch_selected
+        return self.execute(context)
+
+    def execute(self, context):
+        profiler = Bone_core.profiler
+        profiler.start(self.bl_idname)
+
         object = context.scene.objects[self.object_name]
+        bones = context.object.data.edit_bones
+        if self.selected_only:
+            bones = [bone for bone in bones if bone.select]
+
+        targets = Bone_align.target_objects(context.object, object, self)
+        original = Bone_core.read_bones(context.object.data.edit_bones)
+        groups = {}
+        aligned = Bone_align.align_bones(bones, targets, self, self.incremental, groups)
+
+        # Taken from the rows before the run, a re-run that skips every bone
+        # leaves the older snapshots in place
+        if self.backup and aligned:
+            with profiler.phase('snapshot'):
+                Bone_core.take_snapshot(context.object.data, 'Align All', rows=original)
+        record_endpoints(context, context.object.data, aligned, original, [groups[name] for name in aligned])
+        self.report({'INFO'}, '%d bones aligned' % len(aligned))
+
+        Bone_align.count_targets(targets)
+        profiler.count('bones', len(aligned))
+        profiler.finish()
+        drop_panel_state()
+
+        return {'FINISHED'}
+
+class BoneToShapeSnapshotOP(bpy.types.Operator):
+    '''Store head, tail and roll of every bone on the armature'''
+    bl_idname = "bs.snapshot"
+    bl_options = {'REGISTER', 'UNDO'}
+    bl_label = "Snapshot"
+
+    label: bpy.props.StringProperty(default='Snapshot')
+
+    @classmethod
+    def poll(cls, context):
+        return (
+            context.object is not None and context.mode == 'EDIT_ARMATURE'
+        )
+
+    def execute(self, context):
+        Bone_core.take_snapshot(context.object.data, self.label)
+        drop_panel_state()
+
+        return {'FINISHED'}
+
+class BoneToShapeRestoreOP(bpy.types.Operator):
+    '''Put the bones back where the snapshot has them'''
+    bl_idname = "bs.snapshot_restore"
+    bl_options = {'REGISTER', 'UNDO'}
+    bl_label = "Restore"
+
+    snapshot_id: bpy.props.IntProperty()
+    remove: bpy.props.BoolProperty(description='Deletes the snapshot instead')
+
+    @classmethod
+    def poll(cls, context):
+        return (
+            context.object is not None and context.mode == 'EDIT_ARMATURE'
+        )
+
+    def execute(self, context):
+        armature = context.object.data
+        if self.remove:
+            Bone_core.remove_snapshot(armature, self.snapshot_id)
+        else:
+            count = Bone_core.restore_snapshot(armature, self.snapshot_id)
+            self.report({'INFO'}, '%d bones restored' % count)
+        drop_panel_state()
+
+        return {'FINISHED'}
+
+class BoneToShapeProfileOP(bpy.types.Operator):
+    '''Start or stop timing the alignment operators'''
+    bl_idname = "bs.profile"
+    bl_label = "Profile"
 
-        self.o_head = str(bone.head.to_tuple())
-        self.o_tail = str(bone.tail.to_tuple())
+    clear: bpy.props.BoolProperty(description='Deletes the recorded runs instead')
 
-        # bone.name if not exist vertex_group
-        if self.custom_groups:
-            group = object.vertex_groups[self.vertex_group]
+    def execute(self, context):
+        profiler = Bone_core.profiler
+        if self.clear:
+            profiler.clear()
         else:
-            group = object.vertex_groups[bone.name]
-
-        # Preserve length
-        initial_length = bone.length
-
-        # Alignment
-        if self.align_bone:
-            center = self.calc_center(object, group)
-            if self.alignment == 'HEAD':
-                bone.head = center
-            if self.alignment == 'TAIL':
-                bone.tail = center
-            if self.alignment == 'CENTER':
-                head, tail = self.center_bone(bone, center)
-                bone.head = head
-                bone.tail = tail
-
-        # Head alignment between
-        if self.head_between:
-            if self.head_group:
-                head_group = object.vertex_groups[self.head_group]
-                if head_group:
-                    pos = self.calc_center_between_groups(object, group, head_group)
-                    bone.head = pos
-
-        # Tail alignment between
-        if self.tail_between:
-            if self.tail_group:
-                tail_group = object.vertex_groups[self.tail_group]
-                if tail_group:
-                    pos = self.calc_center_between_groups(object, group, tail_group)
-                    bone.tail = pos
-
-        # Preserver length On
-        if self.preserve_length:
-            bone.length = initial_length
-
-        # Parent connect
-        if self.parent_connect:
-            parent = bone.parent
-            if parent:
-                bone.head = parent.tail
+            profiler.enabled = not profiler.enabled
+        for area in context.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
+
+        return {'FINISHED'}
+
+class BoneToShapeProfileExportOP(bpy.types.Operator):
+    '''Save the recorded runs as JSON, or CSV with a .csv name'''
+    bl_idname = "bs.profile_export"
+    bl_label = "Export Profile"
+
+    filepath: bpy.props.StringProperty(subtype='FILE_PATH', default='bone_to_shape_profile.json')
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        path = bpy.path.abspath(self.filepath)
+        Bone_core.profiler.export(path)
+        self.report({'INFO'}, '%d runs saved to %s' % (len(Bone_core.profiler.records), path))
+
+        return {'FINISHED'}
+
+class BoneToShapeQualityOP(bpy.types.Operator):
+    '''Measure how well every aligned bone fits its vertex group and flag the outliers'''
+    bl_idname = "bs.quality_report"
+    bl_label = "Check Alignment"
+
+    object_name: bpy.props.StringProperty()
+    use_evaluated: bpy.props.BoolProperty()
+    all_meshes: bpy.props.BoolProperty()
+
+    @classmethod
+    def poll(cls, context):
+        return (
+            context.object is not None and context.mode == 'EDIT_ARMATURE'
+        )
+
+    def invoke(self, context, event):
+        bs_props = context.scene.bs_props
+        self.object_name = bs_props.target.name
+        self.use_evaluated = bs_props.use_evaluated
+        self.all_meshes = bs_props.all_meshes
+        return self.execute(context)
+
+    def execute(self, context):
+        profiler = Bone_core.profiler
+        profiler.start(self.bl_idname)
+
+        object = context.scene.objects[self.object_name]
+        with profiler.phase('residuals'):
+            report = Bone_align.quality_report(context.object, object, self)
+        quality_reports[context.object.data.name] = report
+
+        profiler.count('bones', len(report['bones']))
+        profiler.finish()
+        self.report(
+            {'WARNING'} if report['outliers'] else {'INFO'},
+            '%d bones checked, %d flagged' % (len(report['bones']), len(report['outliers']))
+        )
+
+        return {'FINISHED'}
+
+class BoneToShapeQualityExportOP(bpy.types.Operator):
+    '''Save the last alignment check of the armature as JSON'''
+    bl_idname = "bs.quality_export"
+    bl_label = "Export Check"
+
+    filepath: bpy.props.StringProperty(subtype='FILE_PATH', default='bone_to_shape_quality.json')
+
+    @classmethod
+    def poll(cls, context):
+        return context.object is not None and context.object.data.name in quality_reports
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        path = bpy.path.abspath(self.filepath)
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(quality_reports[context.object.data.name], file, indent=2)
+        self.report({'INFO'}, 'Check saved to %s' % path)
+
+        return {'FINISHED'}
+
+# LivePreview of the running bs.live_preview, None when stopped
+live_preview = None
+
+# A refresh rebuilds the target's weight index, a Python pass over every
+# vertex. While the weights keep changing the next refresh waits this many
+# times the last one's cost, so painting keeps most of the frame
+REFRESH_RATIO = 4
+
+def preview_segment(head, tail, center, options):
+    # align_row as bs.to_shape runs it, on plain vectors
+    row = Bone_math.align_row([*head, *tail, 0.0], options, center)
+    return Vector(row[0:3]), Vector(row[3:6])
+
+def previewable(bs_props):
+    # Options the running sums cover: plain mean of the target's own group,
+    # no volume, principal axis, fitted length or between groups
+    return (
+        bs_props.align_bone and bs_props.alignment != 'VOLUME' and bs_props.estimator == 'MEAN'
+        and not (bs_props.orient or bs_props.fit_length or bs_props.head_between
+                 or bs_props.tail_between or bs_props.all_meshes or bs_props.use_evaluated)
+    )
+
+def stop_preview(window_manager=None):
+    # Removes the timer and draw handler of the running preview. Also for a
+    # preview whose modal operator is gone, a loaded file drops it silently
+    global live_preview
+    if live_preview is None:
+        return
+    if live_preview.handle is not None:
+        bpy.types.SpaceView3D.draw_handler_remove(live_preview.handle, 'WINDOW')
+    if live_preview.timer is not None:
+        window_manager = window_manager or bpy.context.window_manager
+        try:
+            window_manager.event_timer_remove(live_preview.timer)
+        except (ReferenceError, ValueError):
+            pass
+    live_preview = None
+
+def draw_preview():
+    if live_preview is None or live_preview.head is None:
+        return
+    rig = bpy.data.objects.get(live_preview.rig_name)
+    if rig is None:
+        return
+
+    coords = [rig.matrix_world @ live_preview.head, rig.matrix_world @ live_preview.tail]
+    shader = gpu.shader.from_builtin('UNIFORM_COLOR')
+    batch = batch_for_shader(shader, 'LINES', {"pos": coords})
+    gpu.state.line_width_set(3)
+    shader.uniform_float("color", (1.0, 0.6, 0.1, 1.0))
+    batch.draw(shader)
+    gpu.state.line_width_set(1)
+
+class LivePreview:
+    # Running sums of the previewed group, refreshed when the target changes.
+    # The sums only add the changed weights, reading them still rebuilds the
+    # whole weight index, so refreshes are spaced by REFRESH_RATIO
+    def __init__(self, rig, bone, object, group):
+        self.rig_name = rig.name
+        self.bone_name = bone.name
+        self.object_name = object.name
+        self.group_index = group.index
+        self.head = bone.head.copy()
+        self.tail = bone.tail.copy()
+        self.sums = Bone_math.RunningCentroid()
+        self.dirty = True
+        self.next_refresh = 0.0
+        self.pending = False
+        self.running = True
+        self.timer = None
+        self.handle = None
+
+    def refresh(self, object):
+        # Only the group's members, from the weight index, and their positions
+        start = time.perf_counter()
+        weights = Bone_core.mesh_weights(object)
+        indices, group = weights.group(self.group_index)
+        points = Bone_math.to_world(weights.group_coords(self.group_index), object.matrix_world)
+        self.sums.update(indices, points, group)
+        self.dirty = False
+        end = time.perf_counter()
+        self.next_refresh = end + (end - start) * REFRESH_RATIO
+
+        center = self.sums.center
+        return None if center is None else Vector(center)
+
+class BoneToShapeLiveOP(AlignOptions, bpy.types.Operator):
+    '''Keep aligning the bone while the target weights change, Esc or the button again stops it'''
+    bl_idname = "bs.live_preview"
+    bl_label = "Live Preview"
+
+    bone_name: bpy.props.StringProperty()
+    object_name: bpy.props.StringProperty()
+    vertex_group: bpy.props.StringProperty()
+    custom_groups: bpy.props.BoolProperty()
+
+    @classmethod
+    def poll(cls, context):
+        return (
+            context.object is not None and context.mode == 'EDIT_ARMATURE'
+        )
+
+    def invoke(self, context, event):
+        global live_preview
+
+        # Second click stops the running preview
+        if live_preview is not None:
+            live_preview.running = False
+            return {'FINISHED'}
+
+        fill_from_panel(self, context)
+
+        rig = context.object
+        bone = rig.data.edit_bones[self.bone_name]
+        object = context.scene.objects[self.object_name]
+        group = object.vertex_groups[self.vertex_group if self.custom_groups else bone.name]
+
+        live_preview = LivePreview(rig, bone, object, group)
+        live_preview.timer = context.window_manager.event_timer_add(1 / 30, window=context.window)
+        live_preview.handle = bpy.types.SpaceView3D.draw_handler_add(
+            draw_preview, (), 'WINDOW', 'POST_VIEW'
+        )
+        context.window_manager.modal_handler_add(self)
+
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if live_preview is None:
+            # Stopped from outside, handlers already removed
+            return {'CANCELLED'}
+        if event.type == 'ESC' or not live_preview.running:
+            return self.finish(context)
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        object = bpy.data.objects.get(live_preview.object_name)
+        rig = bpy.data.objects.get(live_preview.rig_name)
+        if object is None or rig is None:
+            return self.finish(context)
+
+        # Edit bones only exist in edit mode, elsewhere the preview is drawn
+        bone = None
+        if context.mode == 'EDIT_ARMATURE' and context.object == rig:
+            bone = rig.data.edit_bones.get(live_preview.bone_name)
+
+        if not live_preview.dirty or time.perf_counter() < live_preview.next_refresh:
+            # Result computed outside edit mode
+            if bone and live_preview.pending:
+                self.write(bone)
+            return {'PASS_THROUGH'}
+
+        if bone:
+            live_preview.head, live_preview.tail = bone.head.copy(), bone.tail.copy()
+
+        center = live_preview.refresh(object)
+        if center is not None:
+            live_preview.head, live_preview.tail = preview_segment(
+                live_preview.head, live_preview.tail, center, self
+            )
+            live_preview.pending = True
+            if bone:
+                self.write(bone)
+
+        for area in context.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
+
+        return {'PASS_THROUGH'}
+
+    def write(self, bone):
+        bone.head, bone.tail = live_preview.head, live_preview.tail
+        if self.parent_connect and bone.parent:
+            bone.head = bone.parent.tail
+        live_preview.pending = False
+
+    def finish(self, context):
+        stop_preview(context.window_manager)
+        for area in context.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
 
         return {'FINISHED'}
 
+# Owner of the msgbus subscriptions
+_msgbus_owner = object()
+
+def subscribe_panel():
+    # Renaming a vertex group is no depsgraph update
+    bpy.msgbus.subscribe_rna(
+        key=(bpy.types.VertexGroup, 'name'), owner=_msgbus_owner, args=(), notify=drop_panel_state
+    )
+
+@persistent
+def invalidate_weights(scene, depsgraph):
+    # Edited meshes rebuild their weight index on the next alignment
+    for update in depsgraph.updates:
+        if update.is_updated_geometry:
+            drop_panel_state()
+            Bone_core.invalidate(update.id.name)
+            Bone_align.invalidate_bvh(update.id.name)
+            if live_preview and update.id.name == live_preview.object_name:
+                live_preview.dirty = True
+
+@persistent
+def clear_weights(*args):
+    # Subscriptions do not survive loading a file, a running preview neither
+    stop_preview()
+    subscribe_panel()
+    drop_panel_state()
+    last_centers.clear()
+    quality_reports.clear()
+    Bone_core.invalidate()
+    Bone_align.invalidate_bvh()
+    Bone_core.clear_endpoints()
+    Bone_core.clear_fingerprints()
+
 def register():
     bpy.utils.register_class(BoneToShapeProps)
     bpy.utils.register_class(BoneToShapeOP)
+    bpy.utils.register_class(BoneToShapeBatchOP)
+    bpy.utils.register_class(BoneToShapeLiveOP)
+    bpy.utils.register_class(BoneToShapeSnapshotOP)
+    bpy.utils.register_class(BoneToShapeRestoreOP)
+    bpy.utils.register_class(BoneToShapeProfileOP)
+    bpy.utils.register_class(BoneToShapeProfileExportOP)
+    bpy.utils.register_class(BoneToShapeQualityOP)
+    bpy.utils.register_class(BoneToShapeQualityExportOP)
     bpy.utils.register_class(BoneToShapePanel)
 
     bpy.types.Scene.bs_props = bpy.props.PointerProperty(type=BoneToShapeProps)
 
+    bpy.app.handlers.depsgraph_update_post.append(invalidate_weights)
+    bpy.app.handlers.load_post.append(clear_weights)
+    bpy.app.handlers.undo_post.append(undo_panel_state)
+    bpy.app.handlers.redo_post.append(undo_panel_state)
+    subscribe_panel()
+
 def unregister():
+    stop_preview()
     bpy.utils.unregister_class(BoneToShapeProps)
     bpy.utils.unregister_class(BoneToShapeOP)
+    bpy.utils.unregister_class(BoneToShapeBatchOP)
+    bpy.utils.unregister_class(BoneToShapeLiveOP)
+    bpy.utils.unregister_class(BoneToShapeSnapshotOP)
+    bpy.utils.unregister_class(BoneToShapeRestoreOP)
+    bpy.utils.unregister_class(BoneToShapeProfileOP)
+    bpy.utils.unregister_class(BoneToShapeProfileExportOP)
+    bpy.utils.unregister_class(BoneToShapeQualityOP)
+    bpy.utils.unregister_class(BoneToShapeQualityExportOP)
     bpy.utils.unregister_class(BoneToShapePanel)
     
     del bpy.types.Scene.bs_props
 
+    bpy.app.handlers.depsgraph_update_post.remove(invalidate_weights)
+    bpy.app.handlers.load_post.remove(clear_weights)
+    bpy.app.handlers.undo_post.remove(undo_panel_state)
+    bpy.app.handlers.redo_post.remove(undo_panel_state)
+    bpy.msgbus.clear_by_owner(_msgbus_owner)
+
 if __name__ == "__main__":
     register()
-
-"""
-#A futuro:
-#lanzar rayos en todas las direcciones desde un punto, crear una malla con los puntos de impacto de estos rayos, 
-#centrar un vector en esta malla y luego borrar la malla
-
-import bpy
-import bmesh
-from mathutils import Vector, geometry
-
-# Crea un objeto BMesh para la malla nueva
-bm_new = bmesh.new()
-
-# Define el origen del rayo
-ray_origin = Vector((0, 0, 0))
-
-# Define la longitud del rayo (30 cm)
-ray_length = 0.3
-
-# Lanza los rayos en todas las direcciones y crea la malla nueva
-for i in range(360):  # Ajusta este rango según el número de rayos que quieras lanzar
-    for j in range(180):
-        # Calcula la dirección del rayo
-        ray_direction = Vector((i, j, 1)).normalized()
-
-        # Lanza el rayo
-        result, location, normal, index = bpy.context.scene.ray_cast(bpy.context.view_layer, ray_origin, ray_direction)
-
-        # Si el rayo intersecta la malla, crea un nuevo vértice en el punto de intersección
-        if result:
-            vert = bm_new.verts.new(location)
-
-# Calcula el centroide de la malla nueva
-centroid = Vector((0, 0, 0))
-for vert in bm_new.verts:
-    centroid += vert.co
-centroid /= len(bm_new.verts)
-
-print("El centroide de la malla nueva es", centroid)
-
-# Borra la malla nueva
-bpy.ops.object.mode_set(mode='EDIT')
-bpy.ops.mesh.select_all(action='SELECT')
-bpy.ops.mesh.delete(type='VERT')
-bpy.ops.object.mode_set(mode='OBJECT')
-"""
\ No newline at end of file
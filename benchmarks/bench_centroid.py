@@ -0,0 +1,102 @@
+"""
+Centroid engine (first call and cached weight index) vs the old per-vertex loop,
+then a 300 vertex group gathered on its own vs reading every position.
+
+blender --background --factory-startup --python benchmarks/bench_centroid.py -- 10000 100000 1000000
+"""
+
+import os
+import sys
+import time
+
+import bpy
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Bone_core
+
+def legacy_center(object, group):
+    # Copy of the loop BoneToShapeOP.calc_center used before Bone_core
+    center = [0, 0, 0]
+    total_weight = 0
+    for vert in object.data.vertices:
+        for g in vert.groups:
+            if g.group == group.index:
+                center = [c + g.weight * v for c, v in zip(center, object.matrix_world @ vert.co)]
+                total_weight += g.weight
+    if total_weight:
+        center = [c / total_weight for c in center]
+
+    return center
+
+def build_mesh(count, seed=0):
+    rng = np.random.default_rng(seed)
+    mesh = bpy.data.meshes.new('bench_%d' % count)
+    mesh.vertices.add(count)
+    mesh.vertices.foreach_set('co', rng.normal(size=count * 3).astype(np.float32))
+    object = bpy.data.objects.new(mesh.name, mesh)
+    bpy.context.scene.collection.objects.link(object)
+    object.location = (1.0, 2.0, 3.0)
+    object.rotation_euler = (0.3, 0.2, 0.1)
+    bpy.context.view_layer.update()
+
+    # A third of the vertices in the measured group, the rest in a neighbour
+    group = object.vertex_groups.new(name='bench')
+    other = object.vertex_groups.new(name='other')
+    members = rng.random(count) < 1 / 3
+    levels = rng.integers(1, 17, size=count)
+    for level in range(1, 17):
+        indices = np.flatnonzero(members & (levels == level)).tolist()
+        group.add(indices, level / 16, 'REPLACE')
+    other.add(np.flatnonzero(~members).tolist(), 1.0, 'REPLACE')
+
+    # Finger sized group
+    object.vertex_groups.new(name='small').add(list(range(300)), 1.0, 'REPLACE')
+
+    return object, group
+
+def measure(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+def small_group(object):
+    # Index already built, positions not read yet
+    Bone_core.invalidate()
+    weights = Bone_core.mesh_weights(object)
+    index = object.vertex_groups['small'].index
+    matrix = object.matrix_world
+    gather_time, (gathered, _) = measure(Bone_core.group_centroid, weights, matrix, index)
+    full_time, coords = measure(Bone_core.local_coords, object.data)
+    weights._coords = coords
+    _, (full, _) = measure(Bone_core.group_centroid, weights, matrix, index)
+    return gather_time, full_time, float(np.abs(gathered - full).max())
+
+def main(sizes):
+    print('%10s %12s %12s %12s %10s %12s' % (
+        'vertices', 'loop (s)', 'engine (s)', 'cached (s)', 'speedup', 'max diff'
+    ))
+    small = []
+    for count in sizes:
+        object, group = build_mesh(count)
+        loop_time, loop_center = measure(legacy_center, object, group)
+        Bone_core.invalidate()
+        engine_time, (engine_center, total) = measure(Bone_core.object_centroid, object, group.index)
+        # Weight index already built, as on every call after the first one
+        cached_time, _ = measure(Bone_core.object_centroid, object, group.index)
+        diff = float(np.abs(np.array(loop_center) - engine_center).max())
+        print('%10d %12.4f %12.4f %12.4f %9.1fx %12.2e' % (
+            count, loop_time, engine_time, cached_time, loop_time / engine_time, diff
+        ))
+        small.append((count,) + small_group(object))
+        mesh = object.data
+        bpy.data.objects.remove(object)
+        bpy.data.meshes.remove(mesh)
+
+    print('\n%10s %12s %12s %12s' % ('vertices', 'gather (s)', 'all (s)', 'max diff'))
+    for count, gather_time, full_time, diff in small:
+        print('%10d %12.5f %12.5f %12.2e' % (count, gather_time, full_time, diff))
+
+if __name__ == "__main__":
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    main([int(arg) for arg in argv] or [10000, 100000, 1000000])
@@ -0,0 +1,82 @@
+"""
+Rays/s of the VOLUME alignment (cached BVHTree) vs the old scene.ray_cast sketch.
+
+blender --background --factory-startup --python benchmarks/bench_raycast.py -- 128 1024 8192
+"""
+
+import os
+import sys
+import time
+
+import bmesh
+import bpy
+from mathutils import Vector
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Bone_align
+
+def legacy_sketch(origin):
+    # The commented "A futuro" block that used to close Bone_to_shape.py,
+    # with the depsgraph argument ray_cast takes now and without the bpy.ops
+    # clean up at the end
+    bm_new = bmesh.new()
+    for i in range(360):
+        for j in range(180):
+            ray_direction = Vector((i, j, 1)).normalized()
+            result, location, normal, index, object, matrix = bpy.context.scene.ray_cast(
+                bpy.context.view_layer.depsgraph, origin, ray_direction
+            )
+            if result:
+                bm_new.verts.new(location)
+
+    centroid = Vector((0, 0, 0))
+    for vert in bm_new.verts:
+        centroid += vert.co
+    centroid /= max(len(bm_new.verts), 1)
+    bm_new.free()
+
+    return 360 * 180, centroid
+
+class Bone:
+    # Stand-in for an edit bone, volume_center takes its head and tail
+    def __init__(self, head, tail):
+        self.head = Vector(head)
+        self.tail = Vector(tail)
+
+class Options:
+    def __init__(self, ray_count, ray_samples, ray_distance):
+        self.ray_count = ray_count
+        self.ray_samples = ray_samples
+        self.ray_distance = ray_distance
+
+def measure(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+def main(counts):
+    bpy.ops.mesh.primitive_uv_sphere_add(segments=128, ring_count=64, radius=0.1)
+    object = bpy.context.object
+    object.scale = (1.0, 1.0, 3.0)
+    bpy.context.view_layer.update()
+
+    legacy_time, (rays, center) = measure(legacy_sketch, Vector((0.0, 0.0, 0.0)))
+    print('%24s %10d rays %10.4fs %12.0f rays/s' % ('scene.ray_cast sketch', rays, legacy_time, rays / legacy_time))
+
+    build_time, _ = measure(Bone_align.object_bvh, object)
+    print('%24s %26.4fs' % ('BVHTree build (cached)', build_time))
+
+    bone = Bone((0.0, 0.0, -0.2), (0.0, 0.0, 0.2))
+    for count in counts:
+        options = Options(count, 5, 1.0)
+        volume_time, center = measure(
+            Bone_align.volume_center, object, bone.head, bone.tail, options
+        )
+        rays = count * options.ray_samples
+        print('%24s %10d rays %10.4fs %12.0f rays/s  center %s' % (
+            'BVHTree volume_center', rays, volume_time, rays / volume_time, tuple(round(c, 4) for c in center)
+        ))
+
+if __name__ == "__main__":
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    main([int(arg) for arg in argv] or [128, 1024, 8192])
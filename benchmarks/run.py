@@ -0,0 +1,187 @@
+"""
+Speed and output regression suite for the alignment math.
+
+python benchmarks/run.py [--sizes 1000 10000 ...] [--update]
+blender --background --factory-startup --python benchmarks/run.py -- [same options]
+
+Plain Python times the NumPy paths of Bone_core on synthetic clouds. Inside
+Blender the same clouds are built as meshes and timed through the bpy path.
+Results are compared with benchmarks/baselines.json: any output moving more
+than --atol or any path slower than --slowdown times its baseline (and
+--floor seconds) fails. --update stores the current run as the baseline.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import Bone_core
+import Bone_math
+import synthetic
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+# (groups, influences per vertex, noise)
+SHAPES = [(8, 1, 0.0), (64, 4, 0.3)]
+
+HEAD = np.array([0.1, -0.2, 0.3])
+TAIL = np.array([0.4, 0.5, 1.3])
+
+# Estimator settings as BoneToShapeProps holds them
+MEDIAN = SimpleNamespace(estimator='MEDIAN', median_iterations=50)
+
+def best_of(repeat, func, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def measure(weights, matrix, repeat, times, values):
+    # The paths behind calc_center, calc_center_between_groups, center_bone,
+    # the estimators and the batch operator
+    times['calc_center'], (center, _) = best_of(repeat, Bone_core.group_centroid, weights, matrix, 0)
+    times['between'], between = best_of(repeat, Bone_core.between_centroids, weights, matrix, 0, 1)
+    times['center_bone'], (head, tail) = best_of(repeat, Bone_math.center_segment, HEAD, TAIL, center)
+    times['median'], (median, _) = best_of(repeat, Bone_core.group_centroid, weights, matrix, 0, MEDIAN)
+    times['group_centroids'], (centers, totals) = best_of(
+        repeat, Bone_core.group_centroids, weights, matrix
+    )
+
+    times['segments'], (heads, tails, _, _) = best_of(
+        repeat, Bone_core.group_segments, weights, matrix
+    )
+
+    values['calc_center'] = center.tolist()
+    values['between'] = between.tolist()
+    values['center_bone'] = head.tolist() + tail.tolist()
+    values['median'] = median.tolist()
+    values['group_centroids'] = centers.sum(axis=0).tolist() + [float(totals.sum())]
+    # Axis signs are arbitrary, the lengths are not
+    values['segments'] = [float(np.linalg.norm(tails - heads, axis=1).sum())]
+
+def run_numpy(cloud, repeat):
+    coords, groups, vertices, weights, matrix = cloud
+    times, values = {}, {}
+    times['index'], mesh_weights = best_of(repeat, Bone_core.MeshWeights, groups, vertices, weights, coords)
+    measure(mesh_weights, matrix, repeat, times, values)
+    return times, values
+
+def build_object(cloud):
+    coords, groups, vertices, weights, matrix = cloud
+    mesh = bpy.data.meshes.new('bench')
+    mesh.vertices.add(len(coords))
+    mesh.vertices.foreach_set('co', coords.ravel())
+    object = bpy.data.objects.new('bench', mesh)
+    bpy.context.scene.collection.objects.link(object)
+    object.matrix_world = [list(row) for row in matrix]
+
+    # One add() per group and weight level, weights are quantized
+    for group_index in range(groups.max() + 1):
+        group = object.vertex_groups.new(name=str(group_index))
+        members = groups == group_index
+        for weight in np.unique(weights[members]):
+            indices = vertices[members & (weights == weight)]
+            group.add(indices.tolist(), float(weight), 'REPLACE')
+
+    return object
+
+def run_blender(cloud, repeat):
+    object = build_object(cloud)
+    times, values = {}, {}
+
+    def index():
+        Bone_core.invalidate()
+        weights = Bone_core.mesh_weights(object)
+        weights.coords # Loaded on first use otherwise
+        return weights
+
+    times['index'], mesh_weights = best_of(repeat, index)
+    measure(mesh_weights, np.array(object.matrix_world), repeat, times, values)
+
+    mesh = object.data
+    bpy.data.objects.remove(object)
+    bpy.data.meshes.remove(mesh)
+    Bone_core.invalidate()
+    return times, values
+
+def compare(name, result, baseline, args):
+    failures = []
+    times, values = result
+    for path, seconds in times.items():
+        base = baseline['times'].get(path)
+        if base is not None and seconds > base * args.slowdown and seconds - base > args.floor:
+            failures.append('%s %s: %.4fs, baseline %.4fs' % (name, path, seconds, base))
+    for path, value in values.items():
+        base = baseline['values'].get(path)
+        if base is not None and not np.allclose(value, base, rtol=0, atol=args.atol):
+            shift = float(np.abs(np.subtract(value, base)).max())
+            failures.append('%s %s: output moved by %.3g' % (name, path, shift))
+    return failures
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='run.py')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--slowdown', type=float, default=2.0)
+    parser.add_argument('--floor', type=float, default=0.005)
+    parser.add_argument('--atol', type=float, default=1e-6)
+    parser.add_argument('--update', action='store_true')
+    args = parser.parse_args(argv)
+
+    mode = 'numpy' if bpy is None else 'blender'
+    run = run_numpy if bpy is None else run_blender
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES, encoding='utf-8') as file:
+            baselines = json.load(file)
+    stored = baselines.setdefault(mode, {})
+
+    failures = []
+    for size in args.sizes:
+        for group_count, influences, noise in SHAPES:
+            name = '%d-%dg-%di' % (size, group_count, influences)
+            # Blender stores weights as floats, quantized so both sides match
+            cloud = synthetic.make_cloud(size, group_count, influences, noise, levels=64)
+            times, values = run(cloud, args.repeat)
+            print('%-10s %-20s %s' % (mode, name, '  '.join(
+                '%s %.4fs' % (path, seconds) for path, seconds in times.items()
+            )))
+
+            if name in stored and not args.update:
+                failures += compare(name, (times, values), stored[name], args)
+            elif name not in stored:
+                print('%-10s %-20s no baseline' % (mode, name))
+            if args.update:
+                stored[name] = {'times': times, 'values': values}
+
+    if args.update:
+        with open(BASELINES, 'w', encoding='utf-8') as file:
+            json.dump(baselines, file, indent=1, sort_keys=True)
+            file.write('\n')
+
+    for failure in failures:
+        print('REGRESSION %s' % failure)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]
+    if bpy is not None and '--' not in sys.argv:
+        argv = []
+    sys.exit(main(argv))
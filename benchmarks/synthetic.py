@@ -0,0 +1,31 @@
+"""
+Synthetic weighted point clouds for the benchmarks, NumPy only.
+"""
+
+import numpy as np
+
+def make_cloud(vertex_count, group_count, influences=1, noise=0.0, levels=0, seed=0):
+    # Returns coords (n, 3), the deform entries (groups, vertices, weights)
+    # and a matrix_world. Every vertex is in `influences` consecutive groups,
+    # `noise` is the fraction of entries with auto-weighting style 0.001
+    # weights and `levels` quantizes the weights (0 keeps them continuous)
+    rng = np.random.default_rng(seed)
+    coords = rng.normal(size=(vertex_count, 3)).astype(np.float32)
+
+    base = rng.integers(0, group_count, size=vertex_count)
+    groups = (base[:, None] + np.arange(influences)) % group_count
+    vertices = np.repeat(np.arange(vertex_count), influences)
+    weights = rng.random(vertex_count * influences)
+    weights[rng.random(len(weights)) < noise] = 0.001
+    if levels:
+        weights = np.maximum(np.ceil(weights * levels), 1) / levels
+
+    return coords, groups.ravel(), vertices, weights, MATRIX
+
+# Rotation, non uniform scale and translation
+MATRIX = np.array([
+    [0.0, -1.5, 0.0, 1.0],
+    [1.5, 0.0, 0.0, 2.0],
+    [0.0, 0.0, 0.5, 3.0],
+    [0.0, 0.0, 0.0, 1.0],
+])
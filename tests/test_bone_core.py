@@ -0,0 +1,173 @@
+"""
+Behavior of the array side of Bone_core.py, with meshes built from arrays
+instead of Blender data.
+
+python -m pytest tests
+"""
+
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Bone_core
+
+def mesh_weights(entries, coords):
+    # (group, vertex, weight) rows over the given local positions
+    entries = np.asarray(entries, dtype=np.float64).reshape(-1, 3)
+    return Bone_core.MeshWeights(entries[:, 0], entries[:, 1], entries[:, 2], np.asarray(coords, dtype=np.float32))
+
+# Weight index
+
+def test_mesh_weights_rows_per_group():
+    # Entries in any order, group 1 has no members
+    weights = mesh_weights(
+        [(2, 0, 0.5), (0, 1, 1.0), (2, 2, 0.25), (0, 0, 0.75)],
+        [(0, 0, 0), (1, 0, 0), (2, 0, 0)]
+    )
+    assert weights.indptr.tolist() == [0, 2, 2, 4]
+    indices, group = weights.group(0)
+    assert indices.tolist() == [1, 0] and group.tolist() == [1.0, 0.75]
+    indices, group = weights.group(1)
+    assert len(indices) == 0 and len(group) == 0
+    indices, group = weights.group(2)
+    assert indices.tolist() == [0, 2] and group.tolist() == [0.5, 0.25]
+    assert np.allclose(weights.group_coords(2), [(0, 0, 0), (2, 0, 0)])
+
+def test_mesh_weights_group_past_the_last():
+    # Groups without any entry at the end of the list have no row
+    weights = mesh_weights([(0, 0, 1.0)], [(0, 0, 0)])
+    indices, group = weights.group(5)
+    assert len(indices) == 0 and len(group) == 0
+    assert weights.group_coords(5).shape == (0, 3)
+
+def test_mesh_weights_without_entries():
+    weights = mesh_weights([], [(0, 0, 0)])
+    assert weights.indptr.tolist() == [0]
+    assert len(weights.group(0)[0]) == 0
+
+# Profiler
+
+def test_profiler_records_phases_and_counts():
+    profiler = Bone_core.Profiler()
+    profiler.enabled = True
+    profiler.start('op')
+    with profiler.phase('centroid'):
+        with profiler.phase('vertex scan'):
+            pass
+    profiler.count('bones', 3)
+    record = profiler.finish()
+    assert record['operator'] == 'op'
+    assert set(record['phases']) == {'centroid', 'vertex scan'}
+    assert record['counts'] == {'bones': 3}
+    assert profiler.records == [record]
+
+def test_profiler_drops_a_run_left_open():
+    # An operator raised between start() and finish(), then recording was
+    # switched off
+    profiler = Bone_core.Profiler()
+    profiler.enabled = True
+    profiler.start('failed')
+    profiler.enabled = False
+    assert not profiler.active
+    with profiler.phase('centroid'):
+        pass
+    assert profiler.finish() is None
+
+    profiler.enabled = True
+    profiler.start('failed')
+    profiler.start('next')
+    assert profiler.finish()['operator'] == 'next'
+    assert len(profiler.records) == 1
+
+# Group geometry
+
+def test_group_centroids_of_some_groups():
+    # The mirrored sweep only sums the solved side's groups
+    weights = mesh_weights(
+        [(0, 0, 1.0), (0, 1, 1.0), (1, 2, 1.0), (2, 3, 2.0), (2, 0, 1.0)],
+        [(0, 0, 0), (2, 0, 0), (-5, 0, 0), (3, 0, 0)]
+    )
+    matrix = np.eye(4)
+    matrix[:3, 3] = (0, 1, 0)
+    centers, totals = Bone_core.group_centroids(weights, matrix, 4, [0, 2])
+    assert centers.shape == (4, 3)
+    assert np.allclose(centers[0], [1, 1, 0]) and totals[0] == 2.0
+    assert np.allclose(centers[2], [2, 1, 0]) and totals[2] == 3.0
+    assert totals[1] == 0.0 and totals[3] == 0.0
+
+    every, every_totals = Bone_core.group_centroids(weights, matrix, 4)
+    assert np.allclose(every[[0, 2]], centers[[0, 2]])
+    assert every_totals[1] == 1.0
+
+def test_between_centroids():
+    weights = mesh_weights([(0, 0, 1.0), (1, 1, 1.0)], [(0, 0, 0), (2, 0, 0)])
+    assert np.allclose(Bone_core.between_centroids(weights, np.eye(4), 0, 1), [1, 0, 0])
+
+def test_between_centroids_without_weight():
+    weights = mesh_weights([(0, 0, 1.0), (1, 1, 0.0)], [(5, 5, 5), (2, 0, 0)])
+    assert Bone_core.between_centroids(weights, np.eye(4), 0, 1) is None
+    assert Bone_core.between_centroids(weights, np.eye(4), 1, 0) is None
+
+# Blend sliders
+
+def test_endpoints_blend():
+    entry = Bone_core.Endpoints()
+    entry.record(['a', 'b'], [[0, 0, 0, 0, 1, 0], [0, 0, 0, 0, 0, 1]], [[2, 0, 0, 2, 1, 0], [0, 0, 0, 0, 0, 3]])
+    assert np.allclose(entry.blend(1.0, 1.0), entry.aligned)
+    assert np.allclose(entry.blend(0.0, 0.0), entry.original)
+    assert np.allclose(entry.blend(0.5, 0.0), [[1, 0, 0, 0, 1, 0], [0, 0, 0, 0, 0, 1]])
+    assert entry.previous['a'][1] == ('a',)
+
+def test_endpoints_keep():
+    entry = Bone_core.Endpoints()
+    entry.record(['a', 'b', 'c'], np.zeros((3, 6)), np.arange(18).reshape(3, 6), [('a',), ('x', 'y'), ('c',)])
+    entry.keep(np.array([True, False, True]))
+    assert entry.names == ['a', 'c']
+    assert np.allclose(entry.blend(1.0, 1.0), [np.arange(6), np.arange(12, 18)])
+    assert entry.written.shape == (2, 6)
+    # A dropped bone is still reported
+    assert entry.previous['b'][1] == ('x', 'y')
+
+def test_snap_connected():
+    root = SimpleNamespace(name='root', parent=None, use_connect=False)
+    arm = SimpleNamespace(name='arm', parent=root, use_connect=True)
+    hand = SimpleNamespace(name='hand', parent=arm, use_connect=True)
+    loose = SimpleNamespace(name='loose', parent=arm, use_connect=False)
+    parents, children = Bone_core.connected_links([root, arm, hand, loose])
+    assert parents == [-1, 0, 1, -1]
+    assert children == [[1], [2], [], []]
+
+    rows = np.zeros((4, 6))
+    rows[1] = [1, 0, 0, 2, 0, 0]
+    Bone_core.snap_connected(rows, 1, parents, children)
+    assert np.allclose(rows[0, 3:6], [1, 0, 0])
+    assert np.allclose(rows[2, 0:3], [2, 0, 0])
+    assert np.allclose(rows[3], 0)
+
+# Quality report
+
+def test_quality_report_without_bones():
+    assert Bone_core.quality_report([], np.zeros((0, 6)), [], []) == {'bones': [], 'outliers': []}
+
+def test_quality_report_shared_groups():
+    # Group 1 sits along +Y, group 0 away from it, the bones are aligned to
+    # group 1 except the last, which has no group in this mesh
+    weights = mesh_weights(
+        [(0, 0, 1.0), (1, 1, 1.0), (1, 2, 1.0), (1, 3, 2.0)],
+        [(5, 0, 0), (0, 0.5, 0), (0, -1, 0), (0, 2, 0)]
+    )
+    rows = np.array([[0, 0, 0, 0, 1, 0]] * 3, dtype=float)
+    original = rows.copy()
+    original[1] += [1, 0, 0, 1, 0, 0]
+    report = Bone_core.quality_report(['a', 'b', 'c'], rows, original, [(weights, np.eye(4), [1, 1, -1])])
+    a, b, c = report['bones']
+    for bone in (a, b):
+        assert bone['weight'] == 4.0
+        assert np.isclose(bone['distance'], (0 + 1 + 2 * 1) / 4)
+        assert np.isclose(bone['behind'], 0.25)
+        assert np.isclose(bone['past'], 0.5)
+    assert a['shift'] == 0.0 and np.isclose(b['shift'], 1.0)
+    assert c['weight'] == 0.0 and c['distance'] is None and c['flags'] == ['no weights']
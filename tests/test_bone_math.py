@@ -0,0 +1,236 @@
+"""
+Behavior of the Blender free math in Bone_math.py.
+
+python -m pytest tests
+"""
+
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Bone_math
+
+def options(**values):
+    # align_row options as the operators hold them
+    defaults = dict(
+        align_bone=True, alignment='CENTER', orient=False, orient_roll=False,
+        preserve_length=False, fit_length=False, length_percentile=0.05
+    )
+    defaults.update(values)
+    return SimpleNamespace(**defaults)
+
+def line(count=11, length=1.0):
+    # Points along +Y from the origin
+    return np.stack([np.zeros(count), np.linspace(0, length, count), np.zeros(count)], axis=1)
+
+# Running sums
+
+def test_running_centroid_adds_changed_weights():
+    points = np.array([[0.0, 0, 0], [2.0, 0, 0], [4.0, 0, 0]])
+    indices = np.arange(3)
+    sums = Bone_math.RunningCentroid()
+    assert sums.update(indices, points, np.array([1.0, 1.0, 0.0])) == 3
+    assert np.allclose(sums.center, [1, 0, 0])
+    assert sums.update(indices, points, np.array([1.0, 1.0, 2.0])) == 1
+    assert np.allclose(sums.center, [2.5, 0, 0])
+    assert sums.update(indices, points, np.array([1.0, 1.0, 2.0])) == 0
+
+def test_running_centroid_restarts_on_other_members():
+    sums = Bone_math.RunningCentroid()
+    sums.update(np.arange(2), np.array([[0.0, 0, 0], [2.0, 0, 0]]), np.ones(2))
+    assert sums.update(np.array([0, 5]), np.array([[0.0, 0, 0], [6.0, 0, 0]]), np.ones(2)) == 2
+    assert np.allclose(sums.center, [3, 0, 0])
+    moved = np.array([[0.0, 0, 0], [8.0, 0, 0]])
+    assert sums.update(np.array([0, 5]), moved, np.ones(2)) == 2
+    assert np.allclose(sums.center, [4, 0, 0])
+
+def test_running_centroid_without_weight():
+    sums = Bone_math.RunningCentroid()
+    sums.update(np.arange(2), np.eye(3)[:2], np.zeros(2))
+    assert sums.center is None
+
+# Estimators
+
+def test_weighted_centroid():
+    center, total = Bone_math.weighted_centroid(np.eye(3), np.array([1.0, 1.0, 2.0]))
+    assert total == 4.0
+    assert np.allclose(center, [0.25, 0.25, 0.5])
+
+def test_weighted_centroid_without_weight():
+    center, total = Bone_math.weighted_centroid(np.eye(3), np.zeros(3))
+    assert total == 0.0
+    assert np.allclose(center, 0.0)
+
+def test_threshold_drops_light_vertices():
+    points = np.array([[0.0, 0, 0], [10.0, 0, 0]])
+    estimator = SimpleNamespace(estimator='THRESHOLD', min_weight=0.1)
+    center, total = Bone_math.robust_centroid(points, np.array([1.0, 0.01]), estimator)
+    assert np.allclose(center, 0.0)
+    assert total == 1.0
+
+def test_threshold_can_leave_no_weight():
+    estimator = SimpleNamespace(estimator='THRESHOLD', min_weight=0.5)
+    _, total = Bone_math.robust_centroid(np.eye(3), np.full(3, 0.1), estimator)
+    assert total == 0.0
+
+def test_top_k_keeps_heaviest():
+    points = np.array([[0.0, 0, 0], [1.0, 0, 0], [9.0, 0, 0]])
+    estimator = SimpleNamespace(estimator='TOP_K', top_k=2)
+    center, _ = Bone_math.robust_centroid(points, np.array([1.0, 1.0, 0.1]), estimator)
+    assert np.allclose(center, [0.5, 0, 0])
+
+def test_trimmed_drops_farthest():
+    points = np.vstack([np.zeros((9, 3)), [[100.0, 0, 0]]])
+    estimator = SimpleNamespace(estimator='TRIMMED', trim=0.1)
+    center, _ = Bone_math.robust_centroid(points, np.ones(10), estimator)
+    assert np.allclose(center, 0.0)
+
+def test_median_ignores_outlier():
+    points = np.array([[0.0, 0, 0], [1.0, 0, 0], [2.0, 0, 0], [1000.0, 0, 0]])
+    estimator = SimpleNamespace(estimator='MEDIAN', median_iterations=200)
+    center, _ = Bone_math.robust_centroid(points, np.ones(4), estimator)
+    assert 0.9 < center[0] < 2.1
+
+# Group sweeps
+
+def test_grouped_centroids_match_per_group():
+    rng = np.random.default_rng(0)
+    points = rng.normal(size=(50, 3))
+    groups = rng.integers(0, 4, size=50)
+    weights = rng.random(50)
+    centers, totals = Bone_math.grouped_centroids(groups, weights, points, 5)
+    for group in range(4):
+        keep = groups == group
+        center, total = Bone_math.weighted_centroid(points[keep], weights[keep])
+        assert np.allclose(centers[group], center)
+        assert np.isclose(totals[group], total)
+    assert totals[4] == 0.0
+
+# Principal axis
+
+def test_principal_segment_covers_extent():
+    head, tail, _ = Bone_math.principal_segment(line(), np.ones(11))
+    assert np.isclose(np.linalg.norm(tail - head), 1.0)
+
+def test_principal_segment_ignores_zero_weight():
+    points = np.vstack([line(), [[0.0, 50.0, 0.0]]])
+    weights = np.append(np.ones(11), 0.0)
+    head, tail, _ = Bone_math.principal_segment(points, weights)
+    assert np.isclose(abs(tail[1] - head[1]), 1.0)
+
+def test_principal_segment_without_weight():
+    assert Bone_math.principal_segment(line(), np.zeros(11)) is None
+
+def test_grouped_segments_match_principal_segment():
+    points = np.vstack([line(), [[0.0, 50.0, 0.0]], line(5, 2.0) + [3.0, 0, 0]])
+    weights = np.concatenate([np.ones(11), [0.0], np.ones(5)])
+    groups = np.repeat([0, 1], [12, 5])
+    indptr = np.array([0, 12, 17])
+    heads, tails, _, _ = Bone_math.grouped_segments(groups, weights, points, indptr, 2)
+    for group, (start, end) in enumerate(zip(indptr[:-1], indptr[1:])):
+        head, tail, _ = Bone_math.principal_segment(points[start:end], weights[start:end])
+        assert np.isclose(np.linalg.norm(tails[group] - heads[group]), np.linalg.norm(tail - head))
+    assert np.isclose(np.linalg.norm(tails[0] - heads[0]), 1.0)
+
+def test_single_vertex_keeps_bone_length():
+    segment = Bone_math.principal_segment(np.array([[3.0, 3.0, 3.0]]), np.ones(1))
+    row = Bone_math.align_row([0, 0, 0, 0, 0, 2, 0], options(orient=True), segment=segment)
+    assert np.allclose(row[:6], [3, 3, 2, 3, 3, 4])
+
+# Length
+
+def test_weighted_quantiles():
+    values = np.array([3.0, 1.0, 2.0, 4.0])
+    weights = np.array([1.0, 1.0, 1.0, 1.0])
+    assert np.allclose(Bone_math.weighted_quantiles(values, weights, (0.25, 1.0)), [1.0, 4.0])
+
+def test_extent_length_percentiles():
+    points = line(101, 10.0)
+    assert np.isclose(Bone_math.extent_length(points, np.ones(101), (0, 1, 0), 0.0), 10.0)
+    assert np.isclose(Bone_math.extent_length(points, np.ones(101), (0, 1, 0), 0.1), 8.0, atol=0.2)
+
+def test_extent_length_ignores_zero_weight():
+    points = np.vstack([line(), [[0.0, 50.0, 0.0]]])
+    weights = np.append(np.ones(11), 0.0)
+    assert np.isclose(Bone_math.extent_length(points, weights, (0, 1, 0), 0.0), 1.0)
+
+@pytest.mark.parametrize('points, weights', [
+    (np.array([[1.0, 2.0, 3.0]]), np.ones(1)),
+    (line(), np.zeros(11)),
+    (np.empty((0, 3)), np.empty(0)),
+])
+def test_extent_length_none(points, weights):
+    assert Bone_math.extent_length(points, weights, (0, 1, 0)) is None
+
+def test_fit_length_about_center():
+    row = Bone_math.align_row(
+        [0, 0, 0, 0, 1, 0, 0], options(fit_length=True, length_percentile=0.0),
+        center=(0, 0.5, 0), extent=(line(11, 4.0), np.ones(11))
+    )
+    assert np.allclose(row[:6], [0, -1.5, 0, 0, 2.5, 0])
+
+def test_preserve_length():
+    row = Bone_math.align_row([0, 0, 0, 0, 1, 0, 0], options(alignment='TAIL', preserve_length=True), center=(0, 3, 0))
+    assert np.allclose(row[:6], [0, 0, 0, 0, 1, 0])
+
+# Roll
+
+@pytest.mark.parametrize('direction', [(0, 1, 0), (0, 0, 1), (1, 2, 3), (0, -1, 0), (0.01, -1, 0.01)])
+def test_roll_axes_orthonormal(direction):
+    x_axis, z_axis = Bone_math.roll_axes((0, 0, 0), direction)
+    y_axis = np.asarray(direction, dtype=float) / np.linalg.norm(direction)
+    assert np.isclose(np.linalg.norm(x_axis), 1.0, atol=1e-3)
+    assert np.isclose(np.linalg.norm(z_axis), 1.0, atol=1e-3)
+    assert abs(np.dot(x_axis, y_axis)) < 1e-3
+    assert abs(np.dot(z_axis, y_axis)) < 1e-3
+
+def test_roll_axes_match_blender():
+    # An edit bone pointing up has its Z axis along -Y at roll 0
+    x_axis, z_axis = Bone_math.roll_axes((0, 0, 0), (0, 0, 1))
+    assert np.allclose(x_axis, [1, 0, 0])
+    assert np.allclose(z_axis, [0, -1, 0])
+
+@pytest.mark.parametrize('roll', [0.0, 0.7, -2.0, 3.0])
+def test_roll_to_vector_round_trip(roll):
+    head, tail = np.zeros(3), np.array([0.3, 1.0, -0.2])
+    z_axis = Bone_math.bone_z_axis(head, tail, roll)
+    assert np.isclose(Bone_math.roll_to_vector(head, tail, z_axis), roll)
+
+def test_roll_to_vector_along_bone_keeps_roll():
+    assert Bone_math.roll_to_vector((0, 0, 0), (0, 1, 0), (0, 2, 0), 0.4) == 0.4
+
+# Quality report
+
+def test_grouped_residuals():
+    points = np.array([[0.0, 0.5, 1.0], [0.0, -1.0, 0.0], [0.0, 3.0, 0.0]])
+    sums = Bone_math.grouped_residuals(
+        np.zeros(3, dtype=np.int64), np.ones(3), points, np.zeros((1, 3)), np.array([[0.0, 1.0, 0.0]])
+    )
+    assert np.allclose(sums[0], [3.0, 1.0 + 1.0 + 2.0, 1.0, 1.0])
+
+def test_outliers():
+    flags = Bone_math.outliers([1.0, 1.1, 0.9, 1.0, 10.0, np.nan])
+    assert flags.tolist() == [False, False, False, False, True, False]
+
+def test_outliers_floor():
+    # A repeat run leaves most shifts at 0
+    values = [0.0, 0.0, 0.0, 0.0, 0.001]
+    assert Bone_math.outliers(values).tolist() == [False] * 4 + [True]
+    assert not Bone_math.outliers(values, floor=0.05).any()
+    assert Bone_math.outliers(values + [0.5], floor=0.05).tolist() == [False] * 5 + [True]
+
+# Fingerprints
+
+def test_fingerprint():
+    values = np.arange(6, dtype=np.float32)
+    assert Bone_math.fingerprint(values, 'a') == Bone_math.fingerprint(values.copy(), 'a')
+    assert Bone_math.fingerprint(values) != Bone_math.fingerprint(values.reshape(2, 3))
+    assert Bone_math.fingerprint(values) != Bone_math.fingerprint(values.astype(np.float64))
+    assert Bone_math.fingerprint(values, 'a') != Bone_math.fingerprint(values, 'b')
+    changed = values.copy()
+    changed[3] += 1e-3
+    assert Bone_math.fingerprint(values) != Bone_math.fingerprint(changed)
@@ -0,0 +1,196 @@
+"""
+Runs the same alignment jobs over many .blend files with several Blender
+workers. Plain Python, no bpy needed:
+
+python tools/align_farm.py jobs.json files.txt --workers 8 --blender /opt/blender/blender
+
+Files come as .blend paths or text files with one path per line. Every
+finished file is appended to the checkpoint, running the same command again
+skips the files already done. Each file runs tools/align_jobs.py and is saved
+when all its jobs succeed.
+"""
+
+import argparse
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'align_jobs.py')
+
+def read_files(sources):
+    files = []
+    for source in sources:
+        if source.endswith('.blend'):
+            files.append(source)
+            continue
+        with open(source, encoding='utf-8') as file:
+            files += [line.strip() for line in file if line.strip()]
+    return [os.path.abspath(path) for path in files]
+
+def read_checkpoint(path):
+    # Files whose last record finished ok. A crashed run can leave the last
+    # line half written, lines that don't parse are skipped
+    done = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                    done[record['file']] = record
+                except (ValueError, KeyError, TypeError):
+                    continue
+    return {file: record for file, record in done.items() if record.get('status') == 'ok'}
+
+def end_checkpoint(path):
+    # New records start on their own line after a half written one
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb+') as file:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b'\n':
+                file.write(b'\n')
+
+class Farm:
+    def __init__(self, args):
+        self.args = args
+        self.work = queue.Queue()
+        self.lock = threading.Lock()
+        self.records = []
+
+    def command(self, path, report):
+        command = [
+            self.args.blender, '--background', '--factory-startup', path,
+            '--python', RUNNER, '--', self.args.jobs, '--report', report
+        ]
+        if not self.args.no_save:
+            command.append('--save')
+        return command
+
+    def run_file(self, path):
+        # One Blender process, returns the checkpoint record. Never raises,
+        # a missing Blender or a bad report is an error record like a timeout
+        record = {'file': path}
+        start = time.perf_counter()
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                report = os.path.join(folder, 'report.json')
+                process = subprocess.run(
+                    self.command(path, report),
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    timeout=self.args.timeout,
+                    text=True
+                )
+                if process.returncode == 0 and os.path.exists(report):
+                    with open(report, encoding='utf-8') as file:
+                        result = json.load(file)
+                    record.update(status='ok', bones=result['bones'], jobs=len(result['jobs']))
+                else:
+                    tail = process.stdout.strip().splitlines()[-5:]
+                    record.update(status='error', error='exit %d' % process.returncode, log=tail)
+        except subprocess.TimeoutExpired:
+            record.update(status='error', error='timeout after %ss' % self.args.timeout)
+        except Exception as error:
+            record.update(status='error', error='%s: %s' % (type(error).__name__, error))
+        record['seconds'] = time.perf_counter() - start
+        return record
+
+    def worker(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+            path, attempt = item
+            try:
+                record = self.run_file(path)
+                record['attempt'] = attempt
+
+                if record['status'] != 'ok' and attempt < self.args.retries:
+                    print('align_farm: retrying %s (%s)' % (path, record['error']))
+                    self.work.put((path, attempt + 1))
+                else:
+                    self.finish(record)
+            finally:
+                # run() waits on every item, even one whose record failed
+                self.work.task_done()
+
+    def finish(self, record):
+        with self.lock:
+            self.records.append(record)
+            with open(self.args.checkpoint, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(record) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            print('align_farm: [%d] %s %s in %.1fs' % (
+                len(self.records), record['status'], record['file'], record['seconds']
+            ))
+
+    def run(self, files):
+        for path in files:
+            self.work.put((path, 0))
+
+        threads = [threading.Thread(target=self.worker) for _ in range(self.args.workers)]
+        for thread in threads:
+            thread.start()
+        self.work.join()
+        for thread in threads:
+            self.work.put(None)
+        for thread in threads:
+            thread.join()
+
+        return self.records
+
+def summary(records, skipped, seconds):
+    ok = [record for record in records if record['status'] == 'ok']
+    bones = sum(record['bones'] for record in ok)
+    return {
+        'files': len(records),
+        'ok': len(ok),
+        'failed': [record['file'] for record in records if record['status'] != 'ok'],
+        'skipped': skipped,
+        'bones': bones,
+        'seconds': seconds,
+        'files_per_minute': len(ok) / seconds * 60 if seconds else 0.0,
+        'bones_per_second': bones / seconds if seconds else 0.0,
+    }
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='align_farm.py')
+    parser.add_argument('jobs', help='job file for tools/align_jobs.py')
+    parser.add_argument('files', nargs='+', help='.blend files or text files listing them')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--blender', default='blender')
+    parser.add_argument('--retries', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=None, help='seconds per file')
+    parser.add_argument('--checkpoint', default='align_farm.checkpoint.jsonl')
+    parser.add_argument('--report', default='align_farm.report.json')
+    parser.add_argument('--no-save', action='store_true', help='only reports, files are not saved')
+    args = parser.parse_args(argv)
+    args.jobs = os.path.abspath(args.jobs)
+
+    files = read_files(args.files)
+    done = read_checkpoint(args.checkpoint)
+    end_checkpoint(args.checkpoint)
+    pending = [path for path in files if path not in done]
+    print('align_farm: %d files, %d already done, %d workers' % (
+        len(files), len(files) - len(pending), args.workers
+    ))
+
+    start = time.perf_counter()
+    records = Farm(args).run(pending)
+    report = summary(records, len(files) - len(pending), time.perf_counter() - start)
+    report['records'] = records
+
+    with open(args.report, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    print('align_farm: %(ok)d/%(files)d ok, %(files_per_minute).1f files/min, '
+          '%(bones_per_second).1f bones/s' % report)
+
+    return 1 if report['failed'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
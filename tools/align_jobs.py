@@ -0,0 +1,275 @@
+"""
+Runs a file of alignment jobs without the UI.
+
+blender --background rig.blend --python tools/align_jobs.py -- jobs.json [--report report.json] [--save]
+
+The job file is a JSON list (or {"jobs": [...]}) or JSON lines, one job each:
+
+    {"rig": "Armature", "target": "Body", "bones": ["spine", "neck"],
+     "alignment": "CENTER", "preserve_length": true, "parent_connect": false,
+     "head_group": "", "tail_group": ""}
+
+"bone" takes a single name and leaving both out aligns every bone with a
+vertex group, an empty "bones" list aligns none. head_between/tail_between default to whether a group is set.
+"operator": "bone.weight_alignment" runs a job the way the Bone Weight
+Alignment add-on does (length preserved, no between groups or parent connect).
+"alignment": "VOLUME" jobs also take ray_count, ray_samples and ray_distance.
+"fit_length": true sizes each bone to the 5th-95th percentile of its group's
+weight along the bone ("length_percentile", default 0.05).
+"all_meshes": true combines each group over every mesh parented to the rig.
+"mirror": "MIRROR" computes one bone of each .L/.R pair and mirrors it on the
+other, "AVERAGE" averages both sides first.
+The whole file is checked before any bone is touched.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import bpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Bone_core
+import Bone_align
+
+ALIGNMENTS = ('HEAD', 'CENTER', 'TAIL', 'VOLUME')
+OPERATORS = ('bs.to_shape', 'bone.weight_alignment')
+ESTIMATORS = ('MEAN', 'THRESHOLD', 'TOP_K', 'TRIMMED', 'MEDIAN')
+MIRRORS = ('NONE', 'MIRROR', 'AVERAGE')
+
+# Numeric job key: (min, max or None), the bounds of the panel properties
+RANGES = {
+    'length_percentile': (0.0, 0.45),
+    'min_weight': (0.0, 1.0),
+    'top_k': (1, None),
+    'trim': (0.0, 0.9),
+    'median_iterations': (1, 1000),
+    'ray_count': (4, 10000),
+    'ray_samples': (1, 64),
+    'ray_distance': (0.001, None),
+}
+
+# Job key: (type, default)
+JOB_KEYS = {
+    'operator': (str, 'bs.to_shape'),
+    'rig': (str, None),
+    'target': (str, None),
+    'bone': (str, None),
+    'bones': (list, None),
+    'alignment': (str, 'CENTER'),
+    'align_bone': (bool, True),
+    'preserve_length': (bool, False),
+    'fit_length': (bool, False),
+    'length_percentile': (float, 0.05),
+    'parent_connect': (bool, False),
+    'head_between': (bool, None),
+    'tail_between': (bool, None),
+    'head_group': (str, ''),
+    'tail_group': (str, ''),
+    'use_evaluated': (bool, False),
+    'all_meshes': (bool, False),
+    'orient': (bool, False),
+    'orient_roll': (bool, False),
+    'estimator': (str, 'MEAN'),
+    'min_weight': (float, 0.1),
+    'top_k': (int, 100),
+    'trim': (float, 0.1),
+    'median_iterations': (int, 50),
+    'ray_count': (int, 128),
+    'ray_samples': (int, 5),
+    'ray_distance': (float, 1.0),
+    'mirror': (str, 'NONE'),
+}
+
+def load_jobs(path):
+    with open(path, encoding='utf-8') as file:
+        text = file.read()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        # JSON lines
+        data = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(data, dict):
+        data = data.get('jobs', [data])
+    return data
+
+def parse_job(raw):
+    # Returns (job, errors) with defaults filled in
+    if not isinstance(raw, dict):
+        return None, ['job must be an object']
+
+    errors = ['unknown key "%s"' % key for key in raw if key not in JOB_KEYS]
+    job = {}
+    for key, (kind, default) in JOB_KEYS.items():
+        value = raw.get(key, default)
+        if kind is float and isinstance(value, int) and not isinstance(value, bool):
+            value = float(value)
+        if value is not None and (not isinstance(value, kind) or (kind is not bool and isinstance(value, bool))):
+            errors.append('"%s" must be %s' % (key, kind.__name__))
+        job[key] = value
+
+    for key, (low, high) in RANGES.items():
+        value = job[key]
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            continue
+        if value < low:
+            errors.append('"%s" must be at least %s' % (key, low))
+        elif high is not None and value > high:
+            errors.append('"%s" must be at most %s' % (key, high))
+
+    for key in ('rig', 'target'):
+        if not job[key]:
+            errors.append('"%s" is required' % key)
+    if job['alignment'] not in ALIGNMENTS:
+        errors.append('"alignment" must be one of %s' % ', '.join(ALIGNMENTS))
+    if job['estimator'] not in ESTIMATORS:
+        errors.append('"estimator" must be one of %s' % ', '.join(ESTIMATORS))
+    if job['mirror'] not in MIRRORS:
+        errors.append('"mirror" must be one of %s' % ', '.join(MIRRORS))
+    if job['operator'] not in OPERATORS:
+        errors.append('"operator" must be one of %s' % ', '.join(OPERATORS))
+    if job['bone'] is not None and job['bones'] is not None:
+        errors.append('use "bone" or "bones", not both')
+    if isinstance(job['bones'], list) and not all(isinstance(name, str) for name in job['bones']):
+        errors.append('"bones" must be a list of names')
+
+    # Only a missing "bones" means every bone
+    if job['bone'] is not None:
+        job['bones'] = [job['bone']]
+    if job['head_between'] is None:
+        job['head_between'] = bool(job['head_group'])
+    if job['tail_between'] is None:
+        job['tail_between'] = bool(job['tail_group'])
+    if job['operator'] == 'bone.weight_alignment':
+        job.update(
+            preserve_length=True, fit_length=False, parent_connect=False,
+            head_between=False, tail_between=False
+        )
+
+    return job, errors
+
+def check_scene(job):
+    # Errors for names that do not exist in the open file
+    errors = []
+    rig = bpy.data.objects.get(job['rig'])
+    target = bpy.data.objects.get(job['target'])
+
+    if rig is None or rig.type != 'ARMATURE':
+        errors.append('no armature "%s"' % job['rig'])
+    elif job['bones']:
+        errors += ['no bone "%s" in %s' % (name, rig.name)
+                   for name in job['bones'] if name not in rig.data.bones]
+
+    if target is None or target.type != 'MESH':
+        errors.append('no mesh "%s"' % job['target'])
+    elif rig is not None:
+        targets = Bone_align.target_objects(rig, target, SimpleNamespace(**job))
+        for key in ('head_group', 'tail_group'):
+            if job[key] and not any(job[key] in mesh.vertex_groups for mesh in targets):
+                errors.append('no vertex group "%s" in %s' % (job[key], target.name))
+            elif job[key.replace('group', 'between')] and not job[key]:
+                errors.append('"%s" needs "%s"' % (key.replace('group', 'between'), key))
+
+    return errors
+
+def validate(raw_jobs):
+    jobs = []
+    errors = []
+    for index, raw in enumerate(raw_jobs):
+        job, job_errors = parse_job(raw)
+        if not job_errors:
+            job_errors = check_scene(job)
+        errors += ['job %d: %s' % (index, error) for error in job_errors]
+        jobs.append(job)
+
+    return jobs, errors
+
+def edit_rig(rig):
+    if bpy.context.object and bpy.context.object.mode != 'OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+    bpy.context.view_layer.objects.active = rig
+    bpy.ops.object.mode_set(mode='EDIT')
+
+def run_job(job, backed_up):
+    rig = bpy.data.objects[job['rig']]
+    target = bpy.data.objects[job['target']]
+    if bpy.context.object != rig or rig.mode != 'EDIT':
+        edit_rig(rig)
+
+    # One snapshot per rig so the whole run can be restored from the panel
+    if rig.name not in backed_up:
+        Bone_core.take_snapshot(rig.data, 'align_jobs')
+        backed_up.add(rig.name)
+
+    edit_bones = rig.data.edit_bones
+    if job['bones'] is not None:
+        bones = [edit_bones[name] for name in job['bones']]
+    else:
+        bones = list(edit_bones)
+
+    options = SimpleNamespace(**job)
+    targets = Bone_align.target_objects(rig, target, options)
+    return Bone_align.align_bones(bones, targets, options), len(bones)
+
+def run(jobs):
+    results = []
+    backed_up = set()
+    for index, job in enumerate(jobs):
+        result = {'job': index, 'rig': job['rig'], 'target': job['target']}
+        start = time.perf_counter()
+        try:
+            aligned, requested = run_job(job, backed_up)
+        except Exception as error:
+            result.update(status='error', error=str(error))
+        else:
+            result.update(status='ok', bones=requested, aligned=len(aligned))
+            if job['bones'] is not None:
+                result['skipped'] = sorted(set(job['bones']) - set(aligned))
+        result['seconds'] = time.perf_counter() - start
+        results.append(result)
+
+    if bpy.context.object and bpy.context.object.mode != 'OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+
+    return results
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='align_jobs.py')
+    parser.add_argument('jobs', help='JSON or JSON lines job file')
+    parser.add_argument('--report', help='writes the per job report here')
+    parser.add_argument('--save', action='store_true', help='saves the .blend after the jobs')
+    args = parser.parse_args(argv)
+
+    jobs, errors = validate(load_jobs(args.jobs))
+    if errors:
+        for error in errors:
+            print('align_jobs: %s' % error, file=sys.stderr)
+        return 2
+
+    start = time.perf_counter()
+    results = run(jobs)
+    report = {
+        'file': bpy.data.filepath,
+        'jobs': results,
+        'bones': sum(result.get('aligned', 0) for result in results),
+        'seconds': time.perf_counter() - start,
+    }
+    failed = [result for result in results if result['status'] != 'ok']
+
+    if args.save and not failed:
+        bpy.ops.wm.save_mainfile()
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    for result in results:
+        print('align_jobs: job %(job)d %(status)s in %(seconds).3fs' % result)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    sys.exit(main(argv))